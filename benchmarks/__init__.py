@@ -0,0 +1 @@
+"""Synthetic data and a load driver for timing the app, see benchmarks/run.py."""
@@ -0,0 +1,290 @@
+"""Drive the app through the Flask test client and record latencies.
+
+    python -m benchmarks.run --dnvs 100000 --requests 200
+
+Data is generated under benchmarks/data/<dnvs> on first use and reused.
+Results go to benchmarks/results/<commit>-<dnvs>.json unless --output is
+given, so runs at the same scale can be compared across commits.
+"""
+import csv
+import html
+import json
+import os
+import platform
+import re
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+import click
+import numpy as np
+
+from benchmarks.synthetic import DATABASES, ROOT, generate
+from mutable import create_app
+from mutable.api import GENE_TRACKS
+from mutable.protein_link import contact_pairs
+
+BENCHMARK_DIRECTORY = os.path.join(ROOT, 'benchmarks')
+
+# seconds between job status requests while a lollipop upload is processed
+POLL_INTERVAL = 0.05
+JOB_TIMEOUT = 600
+
+# the plot data URL template the gene page fetches its tracks from
+TRACK_URL = re.compile(r'const trackUrl = "([^"]+)"')
+
+# contact cutoff of the lollipop plots and distance.sqlite, in angstrom
+CONTACT_THRESHOLD = 15.0
+# C-alpha spacing of the residue chains contact_pairs is timed on
+RESIDUE_STEP = 3.8
+
+
+def git_revision():
+    def git(*args):
+        return subprocess.run(('git', *args), cwd=ROOT, capture_output=True, text=True).stdout.strip()
+    return {'commit': git('rev-parse', 'HEAD') or None, 'dirty': bool(git('status', '--porcelain', '--', 'mutable'))}
+
+def summarize(latencies, elapsed, errors):
+    latencies = np.array(latencies) * 1000
+    if len(latencies) == 0:
+        return {'requests': 0, 'errors': errors}
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'throughput_rps': round(len(latencies) / elapsed, 2),
+        'mean_ms': round(float(latencies.mean()), 3),
+        'p50_ms': round(float(np.percentile(latencies, 50)), 3),
+        'p90_ms': round(float(np.percentile(latencies, 90)), 3),
+        'p99_ms': round(float(np.percentile(latencies, 99)), 3),
+        'max_ms': round(float(latencies.max()), 3),
+    }
+
+def make_config(data_directory, work_directory, overrides):
+    config = {f'{key}_DATABASE': os.path.join(data_directory, f'{name}.sqlite') for key, name in DATABASES.items()}
+    config.update(
+        SECRET_KEY='benchmark',
+        PDB_DIRECTORY=os.path.join(data_directory, 'pdb'),
+        CENTROID_DIRECTORY=os.path.join(work_directory, 'centroids'),
+        GENE_PAYLOAD_DATABASE=os.path.join(work_directory, 'gene_payload.sqlite'),
+        JOB_DIRECTORY=os.path.join(work_directory, 'jobs'),
+        LOLLIPOP_CACHE_DIRECTORY=os.path.join(work_directory, 'lollipop_cache'),
+    )
+    config.update(overrides)
+    return config
+
+def logged_in_client(app):
+    client = app.test_client()
+    client.get('/auth/guest')
+    return client
+
+def run_scenario(app, paths, threads, request):
+    """Issue request(client, path) for every path on threads clients, return the summary."""
+    clients = threading.local()
+    lock = threading.Lock()
+    latencies = []
+    errors = [0]
+
+    def one(path):
+        client = getattr(clients, 'client', None)
+        if client is None:
+            client = clients.client = logged_in_client(app)
+        start = time.perf_counter()
+        ok = request(client, path)
+        elapsed = time.perf_counter() - start
+        with lock:
+            if ok:
+                latencies.append(elapsed)
+            else:
+                errors[0] += 1
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        list(executor.map(one, paths))
+    return summarize(latencies, time.perf_counter() - start, errors[0])
+
+def get_page(client, path):
+    response = client.get(path)
+    response.close()
+    return response.status_code == 200
+
+def get_gene_page(client, path):
+    """The gene page as a browser loads it: the HTML, every plot track and
+    the first page of the DNV table."""
+    response = client.get(path)
+    page = response.get_data(as_text=True)
+    response.close()
+    match = TRACK_URL.search(page)
+    if response.status_code != 200 or match is None:
+        return False
+    track_url = html.unescape(match.group(1))
+    urls = [track_url.replace('__track__', track) for track in GENE_TRACKS]
+    urls.append(path.replace('/gene/', '/api/gene/', 1) + '/dnvs?sort=id&order=asc')
+    return all(get_page(client, url) for url in urls)
+
+def upload(client, path):
+    """Submit a lollipop upload, wait for its job and fetch the plot page."""
+    with open(path, 'rb') as f:
+        response = client.post('/lollipop', data={'file': (f, os.path.basename(path))})
+    location = response.headers.get('Location', '')
+    if '/lollipop/job/' not in location:
+        return False
+    job_id = location.split('/lollipop/job/')[1].split('/')[0]
+    deadline = time.monotonic() + JOB_TIMEOUT
+    while time.monotonic() < deadline:
+        state = client.get(f'/lollipop/job/{job_id}').get_json()['state']
+        if state in ('done', 'failed'):
+            break
+        time.sleep(POLL_INTERVAL)
+    return state == 'done' and client.get(location).status_code == 200
+
+def write_uploads(directory, data_directory, genes, count, rng):
+    """Gene- and variant-format upload files, each with different variants so
+    no upload is answered from the plot cache."""
+    os.makedirs(directory, exist_ok=True)
+    conn = sqlite3.connect(os.path.join(data_directory, 'misfit.sqlite'))
+    paths = {'gene_format': [], 'variant_format': []}
+    for i in range(count):
+        gene = genes[i % len(genes)]
+        rows = conn.execute(
+            'SELECT Chrom, Pos, Ref, Alt, Ensembl_protein_position, AA_ref, AA_alt FROM misfit WHERE Symbol = ?',
+            (gene,)
+        ).fetchall()
+        picked = [rows[k] for k in rng.choice(len(rows), min(len(rows), 200), replace=False)]
+
+        path = os.path.join(directory, f'gene_{i}.tsv')
+        with open(path, 'w', newline='') as f:
+            writer = csv.writer(f, delimiter='\t')
+            writer.writerow(['gene', 'aa_change', 'consequence'])
+            for chrom, pos, ref, alt, residue, aa_ref, aa_alt in picked:
+                writer.writerow([gene, f'{aa_ref}{residue}{aa_alt}', 'missense'])
+        paths['gene_format'].append(path)
+
+        path = os.path.join(directory, f'variant_{i}.tsv')
+        with open(path, 'w', newline='') as f:
+            writer = csv.writer(f, delimiter='\t')
+            writer.writerow(['CHROM', 'POS', 'REF', 'ALT', 'consequence'])
+            for chrom, pos, ref, alt, residue, aa_ref, aa_alt in picked:
+                writer.writerow([f'chr{chrom}', pos, ref, alt, 'missense'])
+        paths['variant_format'].append(path)
+    conn.close()
+    return paths
+
+def residue_chain(n, rng):
+    """Centroids of an n-residue chain: a random walk of RESIDUE_STEP steps
+    at 3-decimal precision, like the structures load_centroids reads."""
+    steps = rng.normal(size=(n, 3))
+    steps *= RESIDUE_STEP / np.linalg.norm(steps, axis=1, keepdims=True)
+    return np.round(np.cumsum(steps, axis=0), 3).astype(np.float32)
+
+def time_contacts(sizes, repeat, rng):
+    """Time contact_pairs on a residue chain of each size."""
+    results = {}
+    for n in sizes:
+        coords = residue_chain(n, rng)
+        contact_pairs(coords, CONTACT_THRESHOLD)
+        latencies = []
+        start = time.perf_counter()
+        for _ in range(repeat):
+            call_start = time.perf_counter()
+            contact_pairs(coords, CONTACT_THRESHOLD)
+            latencies.append(time.perf_counter() - call_start)
+        results[f'contact_pairs_{n}'] = summarize(latencies, time.perf_counter() - start, 0)
+    return results
+
+@click.command()
+@click.option('--dnvs', default=10000, show_default=True, help='DNVs in the synthetic database (10k to 10M).')
+@click.option('--pdbs', default=20, show_default=True, help='Genes given a synthetic structure.')
+@click.option('--requests', 'n_requests', default=200, show_default=True, help='Requests per page scenario.')
+@click.option('--uploads', default=10, show_default=True, help='Uploads per lollipop scenario.')
+@click.option('--threads', default=1, show_default=True, help='Concurrent clients.')
+@click.option('--residues', default='500,1000,2000,5000', show_default=True,
+              help='Comma-separated chain lengths contact_pairs is timed on, empty to skip.')
+@click.option('--contact-repeat', default=20, show_default=True, help='Timed contact_pairs calls per chain length.')
+@click.option('--seed', default=0, show_default=True)
+@click.option('--data-dir', type=click.Path(file_okay=False), help='Where the synthetic data lives.')
+@click.option('--regenerate', is_flag=True, help='Rebuild the synthetic data even if present.')
+@click.option('--config', 'overrides', default='{}', help='JSON object of extra app config, e.g. {"DB_POOL": false}.')
+@click.option('--output', type=click.Path(dir_okay=False), help='Results file.')
+def main(dnvs, pdbs, n_requests, uploads, threads, residues, contact_repeat, seed, data_dir, regenerate,
+         overrides, output):
+    """Benchmark the gene page (its HTML alone and with its data requests), the sample page, lollipop
+    uploads and the residue contact search."""
+    data_dir = data_dir or os.path.join(BENCHMARK_DIRECTORY, 'data', str(dnvs))
+    manifest_path = os.path.join(data_dir, 'manifest.json')
+    manifest = None
+    if os.path.exists(manifest_path) and not regenerate:
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        if (manifest['dnvs'], manifest['pdbs'], manifest['seed']) != (dnvs, pdbs, seed):
+            manifest = None
+    if manifest is None:
+        click.echo(f'Generating {dnvs} DNVs in {data_dir}')
+        start = time.perf_counter()
+        manifest = generate(data_dir, dnvs, pdbs, seed)
+        click.echo(f'Generated in {time.perf_counter() - start:.1f}s')
+
+    overrides = json.loads(overrides)
+    rng = np.random.default_rng(seed)
+    results = {}
+    with tempfile.TemporaryDirectory() as work_directory:
+        config = make_config(data_dir, work_directory, overrides)
+        app = create_app(config)
+
+        conn = sqlite3.connect(config['DNV_DATABASE'])
+        hit_genes = [gene for gene, in conn.execute('SELECT DISTINCT gene FROM dnvs ORDER BY gene')]
+        conn.close()
+        genes = rng.choice(hit_genes, n_requests)
+        samples = [f'SAMPLE{i}' for i in rng.integers(0, manifest['samples'], n_requests)]
+        scenarios = [
+            ('gene_shell', [f'/gene/{gene}' for gene in genes], get_page),
+            ('gene_page', [f'/gene/{gene}' for gene in genes], get_gene_page),
+            ('sample_page', [f'/sample/{sample}' for sample in samples], get_page),
+        ]
+        if uploads:
+            # one more than timed, the first upload only warms up the job workers
+            upload_paths = write_uploads(os.path.join(work_directory, 'uploads'), data_dir,
+                                         manifest['structure_genes'], uploads + 1, rng)
+            scenarios += [(f'lollipop_{name}', paths, upload) for name, paths in upload_paths.items()]
+
+        for name, paths, request in scenarios:
+            # one untimed request first, so connections and job workers are up
+            run_scenario(app, paths[:1], 1, request)
+            if request is upload:
+                paths = paths[1:]
+            results[name] = run_scenario(app, paths, threads, request)
+            click.echo(f"{name}: {json.dumps(results[name])}")
+
+    sizes = [int(n) for n in residues.split(',') if n.strip()]
+    for name, summary in time_contacts(sizes, contact_repeat, rng).items():
+        results[name] = summary
+        click.echo(f"{name}: {json.dumps(summary)}")
+
+    report = {
+        **git_revision(),
+        'date': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'parameters': {'dnvs': dnvs, 'genes': manifest['genes'], 'samples': manifest['samples'],
+                       'pdbs': manifest['pdbs'], 'requests': n_requests, 'uploads': uploads,
+                       'threads': threads, 'residues': sizes, 'contact_repeat': contact_repeat,
+                       'seed': seed, 'config': overrides},
+        'results': results,
+    }
+    if output is None:
+        commit = (report['commit'] or 'unknown')[:12] + ('-dirty' if report['dirty'] else '')
+        output = os.path.join(BENCHMARK_DIRECTORY, 'results', f'{commit}-{dnvs}.json')
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    click.echo(f'Results written to {output}')
+
+
+if __name__ == '__main__':
+    main()
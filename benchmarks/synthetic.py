@@ -0,0 +1,348 @@
+"""Synthetic instance databases and AlphaFold-like structures for benchmarks.
+
+The tables follow schema/*.sql and the columns the app reads from the
+databases that are downloaded from Zenodo. Gene sizes are skewed, so a few
+genes hold many DNVs like the real data, and every value is drawn from a
+seeded generator so the same scale always gives the same files.
+"""
+import gzip
+import json
+import os
+import sqlite3
+
+import numpy as np
+from werkzeug.security import generate_password_hash
+
+from mutable.auth import GUEST_PASSWORD, GUEST_USERNAME
+from mutable.db import VARIANT_KEY_SQL
+from mutable.distance import DISTANCE_SCHEMA
+from mutable.plddt import pack_plddt
+from mutable.structure import pdb_path
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCHEMA_DIRECTORY = os.path.join(ROOT, 'schema')
+
+# the <NAME>_DATABASE config key of each generated file
+DATABASES = {'USER': 'users', 'DNV': 'dnvs', 'GENE': 'genes', 'DISTANCE': 'distance', 'SAMPLE': 'samples',
+             'CONSTRAINT': 'constraint', 'PLDDT': 'plddt', 'MISFIT': 'misfit'}
+
+GENE_SCHEMA = """
+CREATE TABLE gene (hgnc TEXT, uniprot_id TEXT, ensembl_id TEXT, pli REAL, mis_z REAL, oe_lof REAL,
+                   mim_id TEXT, uniprot_json TEXT, s_het_zeng REAL, gene_full_name TEXT, MisFit_sgene_mis REAL);
+CREATE INDEX idx_gene_hgnc_upper ON gene (UPPER(hgnc));
+CREATE INDEX idx_gene_ensembl_id ON gene (ensembl_id);
+"""
+CONSTRAINT_SCHEMA = """
+CREATE TABLE regional (gene_name TEXT, start_aa TEXT, stop_aa TEXT, oe REAL);
+CREATE INDEX idx_regional_gene_name_upper ON regional (UPPER(gene_name));
+"""
+PLDDT_SCHEMA = """
+CREATE TABLE plddt (id INTEGER PRIMARY KEY, UniProtID TEXT, location INTEGER, pLDDT REAL);
+CREATE INDEX idx_plddt_uniprot_location ON plddt (UniProtID, location);
+"""
+MISFIT_SCHEMA = """
+CREATE TABLE misfit (Chrom TEXT, Pos INTEGER, Ref TEXT, Alt TEXT, Symbol TEXT,
+                     Ensembl_protein_position INTEGER, AA_ref TEXT, AA_alt TEXT, variant_key INTEGER);
+CREATE INDEX idx_misfit_variant_key ON misfit (variant_key, Symbol, Ensembl_protein_position, AA_ref, AA_alt);
+"""
+# missense DNVs kept while generating, the distance and MisFit tables are derived from them
+SCRATCH_SCHEMA = """
+CREATE TABLE missense (dnv_id INTEGER, gene TEXT, chromosome INTEGER, position INTEGER, ref TEXT, alt TEXT,
+                       residue INTEGER, aa_ref TEXT, aa_alt TEXT);
+"""
+
+AMINO_ACIDS = {'A': 'Ala', 'R': 'Arg', 'N': 'Asn', 'D': 'Asp', 'C': 'Cys', 'Q': 'Gln', 'E': 'Glu',
+               'G': 'Gly', 'H': 'His', 'I': 'Ile', 'L': 'Leu', 'K': 'Lys', 'M': 'Met', 'F': 'Phe',
+               'P': 'Pro', 'S': 'Ser', 'T': 'Thr', 'W': 'Trp', 'Y': 'Tyr', 'V': 'Val'}
+BASES = 'ACGT'
+CONSEQUENCES = (('missense_variant', 0.6), ('synonymous_variant', 0.15), ('stop_gained', 0.1),
+                ('frameshift_variant', 0.1), ('splice_donor_variant', 0.05))
+CONDITIONS = ('ASD', 'CHD', 'DD', 'CDH', 'control')
+COHORTS = ('SPARK', 'SSC', 'PCGC', 'DDD')
+DOMAIN_TYPES = ('Domain', 'Region', 'DNA binding')
+
+BATCH_SIZE = 100000
+
+# longest synthetic protein, keeps PDB parsing and the plDDT table bounded
+MAX_LENGTH = 3000
+
+
+def scale(dnvs):
+    """Number of genes and samples for a number of DNVs."""
+    genes = int(min(max(dnvs // 20, 200), 20000))
+    samples = int(max(dnvs // 2, 100))
+    return genes, samples
+
+def _connect(directory, name, schema):
+    path = os.path.join(directory, f'{name}.sqlite')
+    if os.path.exists(path):
+        os.remove(path)
+    conn = sqlite3.connect(path)
+    conn.execute('PRAGMA journal_mode = OFF')
+    conn.execute('PRAGMA synchronous = OFF')
+    conn.executescript(schema)
+    return conn
+
+def _insert(conn, sql, rows):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= BATCH_SIZE:
+            conn.executemany(sql, batch)
+            batch.clear()
+    conn.executemany(sql, batch)
+    conn.commit()
+
+def _schema_file(name):
+    with open(os.path.join(SCHEMA_DIRECTORY, name)) as f:
+        return f.read()
+
+def make_genes(rng, n_genes):
+    """One dict per gene: symbol, UniProt ID, protein length, chromosome and
+    the share of DNVs it receives."""
+    lengths = np.clip(rng.lognormal(6.2, 0.6, n_genes).astype(int), 50, MAX_LENGTH)
+    # Zipf-like weights, the first genes are the recurrently hit ones
+    weights = 1 / np.arange(1, n_genes + 1) ** 0.8
+    weights /= weights.sum()
+    chromosomes = rng.integers(1, 23, n_genes)
+    starts = rng.integers(1, 200_000_000, n_genes)
+    return [{
+        'symbol': f'GENE{i + 1}',
+        'uniprot_id': f'P{i + 1:05d}',
+        'ensembl_id': f'ENSG{i + 1:011d}',
+        'length': int(lengths[i]),
+        'chromosome': int(chromosomes[i]),
+        'start': int(starts[i]),
+        'weight': float(weights[i]),
+    } for i in range(n_genes)]
+
+def write_genes(directory, rng, genes):
+    conn = _connect(directory, 'genes', GENE_SCHEMA)
+    aa = np.array(list(AMINO_ACIDS))
+
+    def rows():
+        for gene in genes:
+            length = gene['length']
+            features = []
+            for begin in sorted(rng.integers(1, length, 3).tolist()):
+                end = min(begin + int(rng.integers(20, 120)), length)
+                features.append({'type': str(rng.choice(DOMAIN_TYPES)), 'begin': begin, 'end': end,
+                                 'description': f'{gene["symbol"]} feature {begin}'})
+            uniprot_json = json.dumps({
+                'sequence': {'length': length, 'sequence': ''.join(rng.choice(aa, length))},
+                'features': features,
+            })
+            yield (gene['symbol'], gene['uniprot_id'], gene['ensembl_id'], float(rng.random()),
+                   float(rng.normal(1, 2)), float(rng.random()), str(100000 + int(rng.integers(0, 900000))),
+                   uniprot_json, float(rng.random() * 0.3), f'{gene["symbol"]} synthetic protein',
+                   float(rng.random() * 0.1))
+
+    _insert(conn, 'INSERT INTO gene VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows())
+    conn.close()
+
+def write_dnvs(directory, rng, genes, n_dnvs, n_samples, scratch):
+    """Write dnvs.sqlite, and its missense DNVs to the scratch database."""
+    conn = _connect(directory, 'dnvs', _schema_file('dnvs.sql'))
+    # bulk load first, index afterwards like ingest-dnvs
+    indexes = conn.execute("SELECT name, sql FROM sqlite_master WHERE type = 'index' AND sql IS NOT NULL").fetchall()
+    for name, _ in indexes:
+        conn.execute(f'DROP INDEX "{name}"')
+
+    weights = np.array([gene['weight'] for gene in genes])
+    lengths = np.array([gene['length'] for gene in genes])
+    names = [name for name, _ in CONSEQUENCES]
+    shares = [share for _, share in CONSEQUENCES]
+    amino_acids = list(AMINO_ACIDS)
+
+    def rows():
+        # drawn a batch at a time, per-row generator calls dominate otherwise
+        for offset in range(0, n_dnvs, BATCH_SIZE):
+            n = min(BATCH_SIZE, n_dnvs - offset)
+            gene_of = rng.choice(len(genes), n, p=weights)
+            consequence_of = rng.choice(len(names), n, p=shares)
+            residues = (rng.random(n) * lengths[gene_of]).astype(int) + 1
+            refs = rng.integers(0, 4, n)
+            alts = (refs + rng.integers(1, 4, n)) % 4
+            aa_refs = rng.integers(0, len(amino_acids), n)
+            aa_alts = (aa_refs + rng.integers(1, len(amino_acids), n)) % len(amino_acids)
+            samples = rng.integers(0, n_samples, n)
+            scores = rng.random((n, 8))
+            missense = []
+            for j in range(n):
+                i = offset + j
+                gene = genes[gene_of[j]]
+                consequence = names[consequence_of[j]]
+                residue = int(residues[j])
+                position = gene['start'] + residue * 3
+                ref, alt = BASES[refs[j]], BASES[alts[j]]
+                aa_ref, aa_alt = amino_acids[aa_refs[j]], amino_acids[aa_alts[j]]
+                transcript = f'ENST{gene_of[j]:011d}'
+                if consequence == 'stop_gained':
+                    aa_change = f'{transcript}:p.{AMINO_ACIDS[aa_ref]}{residue}Ter'
+                elif consequence == 'synonymous_variant':
+                    aa_change = f'{transcript}:p.{AMINO_ACIDS[aa_ref]}{residue}='
+                else:
+                    aa_change = f'{transcript}:p.{AMINO_ACIDS[aa_ref]}{residue}{AMINO_ACIDS[aa_alt]}'
+                if consequence == 'missense_variant':
+                    missense.append((i + 1, gene['symbol'], gene['chromosome'], position, ref, alt,
+                                     residue, aa_ref, aa_alt))
+                sample = int(samples[j])
+                condition = CONDITIONS[sample % len(CONDITIONS)]
+                score = scores[j].tolist()
+                yield (gene['chromosome'], position, ref, alt, f'SAMPLE{sample}',
+                       'unaffected' if condition == 'control' else 'affected', COHORTS[sample % len(COHORTS)],
+                       condition, gene['symbol'], consequence, transcript, aa_change,
+                       f'c.{residue * 3}{ref}>{alt}', score[0] * 40, *score[1:7], score[7] * 1e-4,
+                       f'{gene["chromosome"]}-{position}-{ref}-{alt}-{i}')
+            scratch.executemany('INSERT INTO missense VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', missense)
+
+    _insert(conn, 'INSERT INTO dnvs (chromosome, position, ref, alt, sample, status, cohort, cohort_condition, '
+                  'gene, consequence, transcript, aa_change, dna_change, CADD, REVEL, gMVP, MisFit_D, MisFit_S, '
+                  'AlphaMissense, spliceAI, gnomAD4_AF, vid) '
+                  'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows())
+    scratch.commit()
+    for _, sql in indexes:
+        conn.execute(sql)
+    conn.execute('ANALYZE')
+    conn.commit()
+    conn.close()
+
+def write_samples(directory, n_samples):
+    conn = _connect(directory, 'samples', _schema_file('samples.sql'))
+    _insert(conn, 'INSERT INTO samples (sample, family, sex, status, syndromic, cohort, cohort_condition, '
+                  'twin, phenotype, ndd) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            ((f'SAMPLE{i}', f'FAM{i}', 'F' if i % 2 else 'M',
+              'unaffected' if CONDITIONS[i % len(CONDITIONS)] == 'control' else 'affected', i % 3 == 0,
+              COHORTS[i % len(COHORTS)], CONDITIONS[i % len(CONDITIONS)], False, 'synthetic', i % 2 == 0)
+             for i in range(n_samples)))
+    conn.close()
+
+def write_users(directory):
+    conn = _connect(directory, 'users', _schema_file('user.sql'))
+    conn.execute('INSERT INTO user (username, password) VALUES (?, ?)',
+                 (GUEST_USERNAME, generate_password_hash(GUEST_PASSWORD)))
+    conn.commit()
+    conn.close()
+
+def write_distance(directory, rng, scratch):
+    """Neighbouring missense DNVs of a gene up to 30 residues apart, standing
+    in for the 3D contacts build-distance-db computes."""
+    conn = _connect(directory, 'distance', DISTANCE_SCHEMA)
+    pairs = scratch.execute(
+        """
+        SELECT gene, dnv_id, residue, next_id, next_residue FROM (
+            SELECT gene, dnv_id, residue,
+                   LEAD(dnv_id) OVER w AS next_id, LEAD(residue) OVER w AS next_residue
+            FROM missense
+            WINDOW w AS (PARTITION BY gene ORDER BY residue, dnv_id)
+        )
+        WHERE next_residue - residue <= 30
+        """
+    )
+    _insert(conn, 'INSERT INTO distance VALUES (?, ?, ?, ?, ?, ?, ?)',
+            ((gene, a, residue_a, b, residue_b, float(rng.uniform(4, 15)), residue_b - residue_a)
+             for gene, a, residue_a, b, residue_b in pairs))
+    conn.execute('CREATE INDEX idx_distance_gene_upper ON distance (UPPER(gene))')
+    conn.commit()
+    conn.close()
+
+def write_constraint(directory, rng, genes):
+    conn = _connect(directory, 'constraint', CONSTRAINT_SCHEMA)
+
+    def rows():
+        for gene in genes:
+            cuts = sorted({1, gene['length'], *rng.integers(2, gene['length'], 2).tolist()})
+            for start, stop in zip(cuts, cuts[1:]):
+                yield gene['symbol'], f'p.{start}', f'p.{stop}', float(rng.uniform(0.1, 1.2))
+
+    _insert(conn, 'INSERT INTO regional VALUES (?, ?, ?, ?)', rows())
+    conn.close()
+
+def write_plddt(directory, rng, genes):
+    conn = _connect(directory, 'plddt', PLDDT_SCHEMA)
+
+    def rows():
+        for gene in genes:
+            scores = np.clip(rng.normal(80, 15, gene['length']), 0, 100)
+            for location, score in enumerate(scores.tolist(), 1):
+                yield gene['uniprot_id'], location, score
+
+    _insert(conn, 'INSERT INTO plddt (UniProtID, location, pLDDT) VALUES (?, ?, ?)', rows())
+    # as build-plddt-arrays leaves it
+    pack_plddt(conn)
+    conn.close()
+
+def write_misfit(directory, scratch):
+    """MisFit rows for the missense DNVs, so variant-format uploads resolve."""
+    conn = _connect(directory, 'misfit', MISFIT_SCHEMA)
+    # drop the index while loading, as migrate-indexes builds it on the real file
+    conn.execute('DROP INDEX idx_misfit_variant_key')
+    _insert(conn, 'INSERT INTO misfit (Chrom, Pos, Ref, Alt, Symbol, Ensembl_protein_position, AA_ref, AA_alt) '
+                  'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            scratch.execute('SELECT CAST(chromosome AS TEXT), position, ref, alt, gene, residue, aa_ref, aa_alt '
+                            'FROM missense'))
+    conn.execute(f'UPDATE misfit SET variant_key = {VARIANT_KEY_SQL}')
+    conn.execute('CREATE INDEX idx_misfit_variant_key ON misfit (variant_key, Symbol, Ensembl_protein_position, '
+                 'AA_ref, AA_alt)')
+    conn.commit()
+    conn.close()
+
+def write_pdb(path, rng, length):
+    """AlphaFold-like model: four backbone atoms per residue along a helix."""
+    lines = []
+    serial = 1
+    for residue in range(1, length + 1):
+        base = np.array([2.3 * np.cos(residue * 1.745), 2.3 * np.sin(residue * 1.745), residue * 1.5])
+        for atom in ('N', 'CA', 'C', 'O'):
+            x, y, z = base + rng.normal(0, 0.5, 3)
+            lines.append(f'ATOM  {serial:5d}  {atom:<3s} ALA A{residue:4d}    '
+                         f'{x:8.3f}{y:8.3f}{z:8.3f}  1.00 80.00           {atom[0]}')
+            serial += 1
+    lines.append('END')
+    with gzip.open(path, 'wt') as f:
+        f.write('\n'.join(lines) + '\n')
+
+def generate(directory, dnvs, pdbs=20, seed=0):
+    """Write every database and pdbs structures into directory.
+
+    Returns the manifest, also saved as manifest.json: the parameters, the
+    genes with a structure and the sample names, for picking benchmark
+    requests.
+    """
+    os.makedirs(directory, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    n_genes, n_samples = scale(dnvs)
+    genes = make_genes(rng, n_genes)
+
+    write_users(directory)
+    write_genes(directory, rng, genes)
+    scratch = _connect(directory, 'scratch', SCRATCH_SCHEMA)
+    try:
+        write_dnvs(directory, rng, genes, dnvs, n_samples, scratch)
+        write_distance(directory, rng, scratch)
+        write_misfit(directory, scratch)
+    finally:
+        scratch.close()
+        os.remove(os.path.join(directory, 'scratch.sqlite'))
+    write_samples(directory, n_samples)
+    write_constraint(directory, rng, genes)
+    write_plddt(directory, rng, genes)
+
+    # structures for the most hit genes, the ones uploads are drawn from
+    pdb_directory = os.path.join(directory, 'pdb')
+    os.makedirs(pdb_directory, exist_ok=True)
+    structures = genes[:pdbs]
+    for gene in structures:
+        write_pdb(pdb_path(pdb_directory, gene['uniprot_id']), rng, gene['length'])
+
+    manifest = {
+        'dnvs': dnvs,
+        'genes': n_genes,
+        'samples': n_samples,
+        'pdbs': len(structures),
+        'seed': seed,
+        'structure_genes': [gene['symbol'] for gene in structures],
+    }
+    with open(os.path.join(directory, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
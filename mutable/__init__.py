@@ -10,7 +10,68 @@ def create_app(test_config=None):
         DISTANCE_DATABASE=os.path.join(app.instance_path, 'distance.sqlite'),
         SAMPLE_DATABASE=os.path.join(app.instance_path, 'samples.sqlite'),
         CONSTRAINT_DATABASE=os.path.join(app.instance_path, 'constraint.sqlite'),
-        PLDDT_DATABASE=os.path.join(app.instance_path, 'plddt.sqlite')
+        PLDDT_DATABASE=os.path.join(app.instance_path, 'plddt.sqlite'),
+        MISFIT_DATABASE=os.path.join(app.instance_path, 'misfit.sqlite'),
+        GENE_PAYLOAD_DATABASE=os.path.join(app.instance_path, 'gene_payload.sqlite'),
+        BURDEN_DATABASE=os.path.join(app.instance_path, 'burden.sqlite'),
+        PDB_DIRECTORY=os.path.join(app.instance_path, 'UP000005640_9606_HUMAN_v4'),
+        CENTROID_DIRECTORY=os.path.join(app.instance_path, 'centroids'),
+        # read-only databases keep one connection per worker thread when pooled
+        DB_POOL=True,
+        DB_IMMUTABLE=True,
+        DB_MMAP_SIZE=256 * 1024 * 1024,
+        DB_CACHE_SIZE=-64 * 1024, # negative means KiB, i.e. 64MB page cache
+        # parsed UniProt documents shared by the gene and lollipop pages
+        UNIPROT_CACHE_SIZE=512,
+        UNIPROT_CACHE_TTL=24 * 60 * 60,
+        UNIPROT_CACHE_MAX_BYTES=128 * 1024 * 1024,
+        # suggestions returned by /api/suggest at most
+        SUGGEST_LIMIT=10,
+        # exports are streamed, Parquet ones in row groups of EXPORT_BATCH_ROWS
+        EXPORT_BATCH_ROWS=10000,
+        # gene page plot data is requested with its data version, so it can be kept for long
+        TRACK_MAX_AGE=365 * 24 * 60 * 60,
+        # lollipop uploads are processed by a pool of JOB_WORKERS processes, finished jobs
+        # are removed after JOB_TTL seconds
+        JOB_DIRECTORY=os.path.join(app.instance_path, 'jobs'),
+        JOB_WORKERS=2,
+        JOB_TTL=24 * 60 * 60,
+        # running jobs refresh their status every JOB_HEARTBEAT seconds; a job whose process
+        # is gone, that stops refreshing or is not done after JOB_TIMEOUT seconds is failed
+        JOB_HEARTBEAT=10,
+        JOB_TIMEOUT=60 * 60,
+        # uploads are read UPLOAD_CHUNK_ROWS lines at a time, the rows kept may use at most
+        # UPLOAD_MEMORY_LIMIT bytes
+        UPLOAD_CHUNK_ROWS=100000,
+        UPLOAD_MEMORY_LIMIT=256 * 1024 * 1024,
+        # genes of an upload are plotted by up to LOLLIPOP_GENE_WORKERS processes, out of
+        # LOLLIPOP_GENE_WORKER_SLOTS shared by every job on the host (a job gets fewer, or plots
+        # in its own process, while they are taken); plots are cached by content and dropped
+        # when unused for LOLLIPOP_CACHE_TTL seconds
+        LOLLIPOP_GENE_WORKERS=2,
+        LOLLIPOP_GENE_WORKER_SLOTS=os.cpu_count() or 1,
+        LOLLIPOP_CACHE_DIRECTORY=os.path.join(app.instance_path, 'lollipop_cache'),
+        LOLLIPOP_CACHE_TTL=7 * 24 * 60 * 60,
+        # gzip/brotli for text responses above COMPRESS_MIN_SIZE bytes, exclusions are endpoints
+        # or blueprint names
+        COMPRESS_MIN_SIZE=1024,
+        COMPRESS_LEVEL=6,
+        COMPRESS_BROTLI_QUALITY=5,
+        COMPRESS_MIMETYPES=('text/html', 'text/plain', 'text/css', 'text/javascript',
+                            'text/tab-separated-values', 'application/json', 'application/javascript'),
+        COMPRESS_EXCLUDE=(),
+        # per-process query and stage histograms served at /metrics, Server-Timing headers
+        # on every response when SERVER_TIMING is also set
+        METRICS_ENABLED=False,
+        SERVER_TIMING=False,
+        # requests slower than PROFILE_THRESHOLD seconds leave a cProfile profile in
+        # PROFILE_DIRECTORY, the oldest are removed above PROFILE_MAX_BYTES; see /debug/profiles
+        PROFILE_ENABLED=False,
+        PROFILE_THRESHOLD=1.0,
+        PROFILE_DIRECTORY=os.path.join(app.instance_path, 'profiles'),
+        PROFILE_MAX_BYTES=100 * 1024 * 1024,
+        # GET responses get ETags from the database versions and access tier, see http_cache.py
+        ETAG_EXCLUDE=('auth', 'debug', 'metrics', 'lollipop', 'views.lollipop', 'static'),
     )
 
     if test_config is None:
@@ -26,9 +87,36 @@ def create_app(test_config=None):
     except OSError:
         pass
 
+    from . import profiler
+    profiler.init_app(app)
+
     from . import db
     db.init_app(app)
 
+    from . import gene_cache
+    gene_cache.init_app(app)
+
+    from . import uniprot
+    uniprot.init_app(app)
+
+    from . import suggest
+    suggest.init_app(app)
+
+    from . import structure
+    structure.init_app(app)
+
+    from . import distance
+    distance.init_app(app)
+
+    from . import plddt
+    plddt.init_app(app)
+
+    from . import burden
+    burden.init_app(app)
+
+    from . import ingest
+    ingest.init_app(app)
+
     from . import auth
     app.register_blueprint(auth.bp)
 
@@ -39,4 +127,20 @@ def create_app(test_config=None):
     from . import lollipop
     app.register_blueprint(lollipop.bp)
 
+    from . import api
+    app.register_blueprint(api.bp)
+
+    from . import export
+    app.register_blueprint(export.bp)
+
+    from . import debug
+    app.register_blueprint(debug.bp)
+
+    from . import metrics
+    metrics.init_app(app)
+    app.register_blueprint(metrics.bp)
+
+    from . import http_cache
+    http_cache.init_app(app)
+
     return app
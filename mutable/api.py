@@ -0,0 +1,307 @@
+import base64
+import hashlib
+import json
+import re
+
+from flask import Blueprint, abort, current_app, jsonify, request, stream_with_context
+
+from mutable.auth import login_required
+from mutable.burden import DIMENSIONS, burden_meta, gene_burden, get_burden_db, summary_query, top_genes
+from mutable.db import get_dnv_db
+from mutable.gene import GENE_TRACKS, get_display_fields, get_gene_track
+from mutable.gene_cache import data_version, load_gene_track
+from mutable.suggest import get_gene_index
+
+bp = Blueprint('api', __name__, url_prefix='/api')
+
+# columns of the gene page table in display order, display_fields go before gnomAD4_AF
+TABLE_COLUMNS = ("chromosome", "position", "ref", "alt", "sample", "cohort", "cohort_condition",
+                 "status", "consequence", "transcript", "aa_change", "dna_change")
+FILTER_COLUMNS = ("consequence", "cohort_condition", "status")
+
+PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+# bump when the encoding of the GENE_TRACKS datasets changes
+TRACK_FORMAT = 2
+
+# chr2:166000000-166200000, the chr prefix and thousands separators are optional
+REGION = re.compile(r'^(?:chr)?([0-9]+|X|Y|M|MT):([0-9,]+)-([0-9,]+)$', re.IGNORECASE)
+MAX_REGIONS = 1000
+QUERY_FORMATS = {"ndjson": "application/x-ndjson", "tsv": "text/tab-separated-values"}
+
+
+def score_columns():
+    return tuple(get_display_fields()) + ("gnomAD4_AF",)
+
+def encode_cursor(value, row_id):
+    return base64.urlsafe_b64encode(json.dumps([value, row_id]).encode('utf8')).decode('ascii')
+
+def decode_cursor(cursor):
+    try:
+        value, row_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except Exception:
+        abort(400, "invalid cursor")
+    return value, row_id
+
+def keyset_condition(column, desc, value, row_id):
+    """Rows after (value, row_id) in ORDER BY (column IS NULL), column [DESC], id."""
+    if column == "id":
+        return ("id < ?" if desc else "id > ?"), [row_id]
+    if value is None:
+        return f'("{column}" IS NULL AND id > ?)', [row_id]
+    op = "<" if desc else ">"
+    return (f'("{column}" IS NULL OR "{column}" {op} ? OR ("{column}" = ? AND id > ?))',
+            [value, value, row_id])
+
+@bp.route('/gene/<gene>/dnvs')
+@login_required
+def gene_dnvs(gene):
+    """One page of a gene's DNVs.
+
+    Query parameters: sort (a table column or id), order (asc/desc), limit,
+    cursor (the next value of the previous page), consequence/cohort_condition/
+    status (repeatable exact matches) and min_<score>/max_<score> thresholds.
+    """
+    gene = gene.upper().strip()
+    columns = TABLE_COLUMNS + score_columns()
+
+    sort = request.args.get("sort", "id")
+    if sort != "id" and sort not in columns:
+        abort(400, f"cannot sort by {sort}")
+    desc = request.args.get("order", "asc") == "desc"
+    limit = max(1, min(request.args.get("limit", PAGE_SIZE, type=int), MAX_PAGE_SIZE))
+
+    where = ["UPPER(gene) = ?"]
+    params = [gene]
+    for column in FILTER_COLUMNS:
+        values = request.args.getlist(column)
+        if values:
+            where.append(f'"{column}" IN ({", ".join("?" * len(values))})')
+            params += values
+    for column in score_columns():
+        for prefix, op in (("min_", ">="), ("max_", "<=")):
+            threshold = request.args.get(prefix + column, type=float)
+            if threshold is not None:
+                where.append(f'"{column}" {op} ?')
+                params.append(threshold)
+
+    dnv_db = get_dnv_db()
+    total = dnv_db.execute(
+        f"SELECT COUNT(*) FROM dnvs WHERE {' AND '.join(where)}", params
+    ).fetchone()[0]
+
+    cursor = request.args.get("cursor")
+    if cursor:
+        condition, cursor_params = keyset_condition(sort, desc, *decode_cursor(cursor))
+        where.append(condition)
+        params += cursor_params
+
+    if sort == "id":
+        order_by = "id DESC" if desc else "id"
+    else:
+        order_by = f'("{sort}" IS NULL), "{sort}"{" DESC" if desc else ""}, id'
+
+    select = ", ".join(f'"{column}"' for column in ("id",) + columns)
+    rows = dnv_db.execute(
+        f"""
+        SELECT {select}
+        FROM dnvs
+        WHERE {' AND '.join(where)}
+        ORDER BY {order_by}
+        LIMIT ?
+        """, params + [limit + 1]
+    ).fetchall()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        next_cursor = encode_cursor(last["id"] if sort == "id" else last[sort], last["id"])
+
+    return jsonify(
+        columns=("id",) + columns,
+        rows=[tuple(row) for row in rows],
+        total=total,
+        next=next_cursor,
+    )
+
+
+def parse_region(text):
+    """(chromosome, start, end) of chr:start-end, chromosomes stored as in dnvs."""
+    match = REGION.match(text.strip())
+    if not match:
+        abort(400, f"invalid region {text}")
+    chromosome, start, end = match.groups()
+    start, end = int(start.replace(",", "")), int(end.replace(",", ""))
+    if start > end:
+        abort(400, f"invalid region {text}")
+    chromosome = int(chromosome) if chromosome.isdigit() else chromosome.upper()
+    return chromosome, start, end
+
+def merge_regions(regions):
+    # overlapping regions would return their shared variants twice
+    merged = []
+    for chromosome, start, end in sorted(regions, key=lambda r: (str(r[0]), r[1])):
+        if merged and merged[-1][0] == chromosome and start <= merged[-1][2]:
+            merged[-1][2] = max(merged[-1][2], end)
+        else:
+            merged.append([chromosome, start, end])
+    return merged
+
+def query_values(name):
+    """Repeated or comma/whitespace-separated values of a parameter, from the
+    query string, a form or a JSON body."""
+    body = request.get_json(silent=True) if request.is_json else None
+    if isinstance(body, dict):
+        values = body.get(name) or []
+        values = [values] if isinstance(values, str) else values
+    else:
+        values = request.values.getlist(name)
+    return [value for item in values for value in re.split(r"[\s,]+", str(item)) if value]
+
+def format_rows(rows, columns, fmt):
+    if fmt == "tsv":
+        yield "\t".join(columns) + "\n"
+        for row in rows:
+            yield "\t".join("" if value is None else str(value) for value in row) + "\n"
+    else:
+        for row in rows:
+            yield json.dumps(dict(zip(columns, row))) + "\n"
+
+@bp.route('/dnvs', methods=('GET', 'POST'))
+@login_required
+def query_dnvs():
+    """DNVs in genomic regions and/or a set of genes, streamed as NDJSON or TSV.
+
+    Parameters: region (chr:start-end, repeatable), genes (symbols, repeatable
+    or comma-separated) and format (ndjson/tsv). Long gene lists can be POSTed
+    as a form or as JSON {"genes": [...], "regions": [...]}. Given both,
+    variants must match a region and a gene.
+    """
+    fmt = request.args.get("format", "ndjson")
+    if fmt not in QUERY_FORMATS:
+        abort(400, f"unknown format {fmt}")
+    regions = [parse_region(region) for region in query_values("region") + query_values("regions")]
+    if len(regions) > MAX_REGIONS:
+        abort(400, f"at most {MAX_REGIONS} regions per request")
+    genes = sorted({gene.upper() for gene in query_values("genes") + query_values("gene")})
+    if not regions and not genes:
+        abort(400, "give a region or genes")
+
+    columns = ("gene",) + TABLE_COLUMNS + score_columns()
+    select = ", ".join(f'"{column}"' for column in columns)
+    # the whole gene list goes in as one JSON array, so a single query
+    # answers it through idx_dnvs_gene_upper
+    gene_condition = "UPPER(gene) IN (SELECT value FROM json_each(?))"
+    gene_params = [json.dumps(genes)]
+
+    if regions:
+        sql = f"SELECT {select} FROM dnvs WHERE chromosome = ? AND position BETWEEN ? AND ?"
+        if genes:
+            sql += f" AND {gene_condition}"
+        queries = [(sql, region + (gene_params if genes else [])) for region in merge_regions(regions)]
+    else:
+        queries = [(f"SELECT {select} FROM dnvs WHERE {gene_condition}", gene_params)]
+
+    dnv_db = get_dnv_db()
+
+    def rows():
+        # rows come straight off the cursors, nothing is held in memory
+        for sql, params in queries:
+            yield from dnv_db.execute(sql, params)
+
+    return current_app.response_class(
+        stream_with_context(format_rows(rows(), columns, fmt)), mimetype=QUERY_FORMATS[fmt]
+    )
+
+
+@bp.route('/suggest')
+@login_required
+def suggest():
+    """Genes whose symbol, Ensembl ID, UniProt ID or full name starts with q."""
+    limit = max(1, min(request.args.get("limit", current_app.config['SUGGEST_LIMIT'], type=int), 100))
+    return jsonify(get_gene_index().suggest(request.args.get("q", ""), limit))
+
+
+@bp.route('/summary')
+@login_required
+def summary():
+    """Top genes by DNVs or distinct samples, see burden.summary_query for the parameters."""
+    burden_db = get_burden_db()
+    if burden_db is None:
+        abort(404, "the burden summary has not been built")
+    query = summary_query()
+    total, rows = top_genes(burden_db, **query)
+    return jsonify(**query, **burden_meta(burden_db), columns=("gene", "dnvs", "samples"),
+                   rows=rows, total=total)
+
+@bp.route('/summary/<gene>')
+@login_required
+def gene_summary(gene):
+    """DNV and sample counts of a gene per cohort_condition, consequence and status."""
+    burden_db = get_burden_db()
+    if burden_db is None:
+        abort(404, "the burden summary has not been built")
+    rows = gene_burden(burden_db, gene.upper().strip())
+    if not rows:
+        abort(404)
+    return jsonify(gene=gene.upper().strip(), columns=DIMENSIONS + ("dnvs", "samples"), rows=rows)
+
+
+def columnar(values):
+    """Turn a list of records into {field: [values]}, missing fields become None."""
+    fields = {}
+    for record in values:
+        for field in record:
+            fields.setdefault(field, None)
+    return {field: [record.get(field) for record in values] for field in fields}
+
+def track_body(track, data):
+    # the plot datasets are {"name": ..., "values": ...}, the legends plain lists,
+    # packed datasets such as pLDDT are sent as they are
+    if isinstance(data, dict) and "encoding" in data:
+        return data
+    if isinstance(data, dict):
+        name, values = data["name"], data["values"]
+    else:
+        name, values = track, data
+    if isinstance(values, list) and all(isinstance(v, dict) for v in values):
+        return {"name": name, "length": len(values), "columns": columnar(values)}
+    return {"name": name, "values": values}
+
+@bp.route('/gene/<gene>/tracks/<track>')
+@login_required
+def gene_track(gene, track):
+    """One plot dataset of the gene page in columnar form.
+
+    The data only changes with the source databases, so the ETag is derived
+    from their versions. Requests made with the current version as ?v= may be
+    cached for TRACK_MAX_AGE seconds.
+    """
+    if track not in GENE_TRACKS:
+        abort(404)
+    gene = gene.upper().strip()
+
+    version = data_version()
+    etag = hashlib.sha1(f"{TRACK_FORMAT}:{version}:{gene}:{track}".encode('utf8')).hexdigest()
+    if request.args.get("v") == version:
+        # private, the tracks are only served to logged in users
+        cache_control = f"private, max-age={current_app.config['TRACK_MAX_AGE']}, immutable"
+    else:
+        cache_control = "no-cache"
+
+    if request.if_none_match.contains_weak(etag):
+        response = current_app.response_class(status=304)
+    else:
+        # read from the payload store where it is up to date, otherwise only this track is computed
+        data = load_gene_track(gene, track)
+        if data is None:
+            data = get_gene_track(gene, track)
+        if data is None:
+            abort(404)
+        response = jsonify(track_body(track, data))
+
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = cache_control
+    return response
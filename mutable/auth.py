@@ -9,6 +9,10 @@ from mutable.db import get_user_db
 
 bp = Blueprint('auth', __name__, url_prefix='/auth')
 
+# dummy username and password assigned to guests
+GUEST_USERNAME = "guest@gmail.com"
+GUEST_PASSWORD = "12345678"
+
 def nologin_required(view):
     @functools.wraps(view)
     def wrapped_view(**kwargs):
@@ -81,16 +85,12 @@ def login():
 
 @bp.route('/guest', methods=('POST','GET'))
 def guestLogin():
-    # dummy username and password assigned to guests
-    guest_username = "guest@gmail.com"
-    guest_password = "12345678"
-
     db = get_user_db()
     guest_user = db.execute(
-        'SELECT * FROM user WHERE username = ?', (guest_username,)
+        'SELECT * FROM user WHERE username = ?', (GUEST_USERNAME,)
     ).fetchone()
 
-    if guest_user and check_password_hash(guest_user['password'], guest_password):
+    if guest_user and check_password_hash(guest_user['password'], GUEST_PASSWORD):
         session.clear()
         session['user_id'] = guest_user['id']
         return redirect(url_for('index'))
@@ -116,6 +116,15 @@ def logout():
     session.clear()
     return redirect(url_for('index'))
 
+def access_tier():
+    """What the current user may see: 'anonymous', 'guest' or 'user'. Pages
+    only differ between tiers, never between users of the same tier."""
+    if g.user is None:
+        return 'anonymous'
+    if g.user['username'] == GUEST_USERNAME:
+        return 'guest'
+    return 'user'
+
 def login_required(view):
     @functools.wraps(view)
     def wrapped_view(**kwargs):
@@ -0,0 +1,178 @@
+import json
+import os
+import time
+
+import click
+from flask import abort, current_app, request
+from flask.cli import with_appcontext
+
+from mutable.db import file_signature, get_readonly_db, replace_database
+
+# counted dimensions of the summary, a row holds the counts of one gene for
+# one value of each; ALL stands for every value, so the totals of a gene, of
+# a gene per condition etc. are rows too and never need summing at query time
+DIMENSIONS = ('cohort_condition', 'consequence', 'status')
+ALL = '*'
+# what a NULL dimension of a DNV is counted under
+MISSING = '.'
+
+SORTS = ('samples', 'dnvs', 'gene')
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 1000
+
+BURDEN_SCHEMA = """
+DROP TABLE IF EXISTS burden;
+DROP TABLE IF EXISTS meta;
+
+CREATE TABLE burden (
+  cohort_condition TEXT NOT NULL,
+  consequence TEXT NOT NULL,
+  status TEXT NOT NULL,
+  gene TEXT NOT NULL,
+  dnvs INTEGER NOT NULL,
+  samples INTEGER NOT NULL,
+  PRIMARY KEY (cohort_condition, consequence, status, gene)
+) WITHOUT ROWID;
+
+CREATE TABLE meta (
+  key TEXT PRIMARY KEY,
+  value TEXT
+) WITHOUT ROWID;
+"""
+
+# built once the rows are in; each top-N ordering reads straight off one of them
+BURDEN_INDEXES = """
+CREATE INDEX idx_burden_samples ON burden (cohort_condition, consequence, status, samples DESC, gene);
+CREATE INDEX idx_burden_dnvs ON burden (cohort_condition, consequence, status, dnvs DESC, gene);
+CREATE INDEX idx_burden_gene ON burden (gene);
+"""
+
+
+def build_burden():
+    """Write burden.sqlite, DNV and distinct-sample counts per gene for every
+    combination of DIMENSIONS values and their ALL rollups.
+
+    Returns the number of genes and rows written.
+    """
+    config = current_app.config
+    path = config['BURDEN_DATABASE']
+    source = config['DNV_DATABASE']
+    if not os.path.exists(source):
+        raise click.ClickException(f'{source} not found.')
+    signature = file_signature(source)
+
+    with replace_database(path) as conn:
+        conn.executescript(BURDEN_SCHEMA)
+        conn.execute('ATTACH DATABASE ? AS source', (source,))
+
+        # one pass over dnvs down to DNVs per gene, dimension values and sample;
+        # the rollups are counted from this much narrower table
+        dimensions = ', '.join(f"COALESCE({d}, '{MISSING}') AS {d}" for d in DIMENSIONS)
+        conn.execute(f"""
+            CREATE TEMP TABLE counts AS
+            SELECT UPPER(gene) AS gene, {dimensions}, sample, COUNT(*) AS dnvs
+            FROM source.dnvs
+            WHERE gene IS NOT NULL
+            GROUP BY 1, 2, 3, 4, 5
+        """)
+        conn.execute('DETACH DATABASE source')
+
+        conn.execute('BEGIN')
+        for mask in range(2 ** len(DIMENSIONS)):
+            kept = [d for i, d in enumerate(DIMENSIONS) if mask & (1 << i)]
+            select = ', '.join(d if d in kept else f"'{ALL}'" for d in DIMENSIONS)
+            conn.execute(f"""
+                INSERT INTO burden (cohort_condition, consequence, status, gene, dnvs, samples)
+                SELECT {select}, gene, SUM(dnvs), COUNT(DISTINCT sample)
+                FROM temp.counts
+                GROUP BY {', '.join(kept + ['gene'])}
+            """)
+        values = {d: [value for value, in conn.execute(f'SELECT DISTINCT {d} FROM temp.counts ORDER BY 1')]
+                  for d in DIMENSIONS}
+        meta = {'source': json.dumps(signature), 'values': json.dumps(values), 'built': str(time.time())}
+        conn.executemany('INSERT INTO meta (key, value) VALUES (?, ?)', meta.items())
+        conn.execute('COMMIT')
+
+        conn.executescript(BURDEN_INDEXES)
+        conn.execute('ANALYZE')
+        genes, rows = conn.execute(
+            "SELECT COUNT(DISTINCT gene), COUNT(*) FROM burden"
+        ).fetchone()
+    return genes, rows
+
+def get_burden_db():
+    """The summary database, None until build-burden has been run."""
+    if not os.path.exists(current_app.config['BURDEN_DATABASE']):
+        return None
+    return get_readonly_db('burden')
+
+def burden_meta(burden_db):
+    meta = dict(burden_db.execute('SELECT key, value FROM meta').fetchall())
+    source = json.loads(meta['source'])
+    return {
+        'values': json.loads(meta['values']),
+        'built': float(meta['built']),
+        # counts lag behind until the next build after dnvs.sqlite changes
+        'stale': source != list(file_signature(current_app.config['DNV_DATABASE']) or ()),
+    }
+
+def summary_query():
+    """Parameters of a top-N request: a value or ALL per dimension, sort
+    (samples/dnvs/gene), order (asc/desc), limit, offset and min_samples."""
+    args = request.args
+    filters = {d: args.get(d) or ALL for d in DIMENSIONS}
+    sort = args.get('sort', 'samples')
+    if sort not in SORTS:
+        abort(400, f'cannot sort by {sort}')
+    order = args.get('order', 'asc' if sort == 'gene' else 'desc')
+    if order not in ('asc', 'desc'):
+        abort(400, f'unknown order {order}')
+    return {
+        'filters': filters,
+        'sort': sort,
+        'order': order,
+        'limit': max(1, min(args.get('limit', PAGE_SIZE, type=int), MAX_PAGE_SIZE)),
+        'offset': max(0, args.get('offset', 0, type=int)),
+        'min_samples': max(0, args.get('min_samples', 0, type=int)),
+    }
+
+def top_genes(burden_db, filters, sort, order, limit, offset, min_samples):
+    """One page of genes for the filters, with the number of genes in all pages."""
+    where = ' AND '.join(f'{d} = ?' for d in DIMENSIONS)
+    params = [filters[d] for d in DIMENSIONS]
+    if min_samples:
+        where += ' AND samples >= ?'
+        params.append(min_samples)
+
+    # ties are broken by gene in the direction idx_burden_<sort> can be read in
+    if sort == 'gene':
+        order_by = 'gene DESC' if order == 'desc' else 'gene'
+    else:
+        order_by = f'{sort} DESC, gene' if order == 'desc' else f'{sort}, gene DESC'
+
+    total = burden_db.execute(f'SELECT COUNT(*) FROM burden WHERE {where}', params).fetchone()[0]
+    rows = burden_db.execute(
+        f'SELECT gene, dnvs, samples FROM burden WHERE {where} ORDER BY {order_by} LIMIT ? OFFSET ?',
+        params + [limit, offset]
+    ).fetchall()
+    return total, [tuple(row) for row in rows]
+
+def gene_burden(burden_db, gene):
+    """Every count of one gene, the ALL rollups included."""
+    rows = burden_db.execute(
+        f"SELECT {', '.join(DIMENSIONS)}, dnvs, samples FROM burden WHERE gene = ? "
+        f"ORDER BY {', '.join(DIMENSIONS)}", (gene,)
+    ).fetchall()
+    return [tuple(row) for row in rows]
+
+@click.command('build-burden')
+@with_appcontext
+def build_burden_command():
+    """Count DNVs and samples per gene, condition, consequence and status."""
+    start = time.perf_counter()
+    genes, rows = build_burden()
+    click.echo(f"Counted {genes} genes in {rows} rows of {current_app.config['BURDEN_DATABASE']} "
+               f"({time.perf_counter() - start:.1f}s).")
+
+def init_app(app):
+    app.cli.add_command(build_burden_command)
@@ -1,14 +1,26 @@
+import os
+import shutil
 import sqlite3
+import tempfile
+import threading
+import time
 import click
 
+from contextlib import contextmanager
+from urllib.request import pathname2url
+
 from flask import current_app, g
+from flask.cli import with_appcontext
+
+from mutable.metrics import connection_class
 
 
 def get_user_db():
     if 'user_db' not in g:
         g.user_db = sqlite3.connect(
             current_app.config["USER_DATABASE"],
-            detect_types=sqlite3.PARSE_DECLTYPES
+            detect_types=sqlite3.PARSE_DECLTYPES,
+            factory=connection_class()
         )
         g.user_db.row_factory = sqlite3.Row
 
@@ -26,37 +38,156 @@ def init_user_db():
     with current_app.open_resource('user_schema.sql') as f:
         user_db.executescript(f.read().decode('utf8'))
 
-def get_dnv_db():
-    if 'dnv_db' not in g:
-        g.dnv_db = sqlite3.connect(
-            current_app.config["DNV_DATABASE"],
-            detect_types=sqlite3.PARSE_DECLTYPES
-        )
-        g.dnv_db.row_factory = sqlite3.Row
-
-    return g.dnv_db
+# read-only databases served from the per-thread connection pool, keyed by
+# the name used in the get_<name>_db helpers and the <NAME>_DATABASE config
+READONLY_DATABASES = ('dnv', 'sample', 'gene', 'distance', 'constraint', 'plddt', 'gene_payload', 'misfit', 'burden')
+
+_pool = threading.local()
+_pool_lock = threading.Lock()
+_pool_stats = {'opened': 0, 'closed': 0, 'reused': 0, 'reopened': 0}
+
+def _count(stat):
+    with _pool_lock:
+        _pool_stats[stat] += 1
+
+def pool_stats():
+    with _pool_lock:
+        stats = dict(_pool_stats)
+    stats['open'] = stats['opened'] - stats['closed']
+    return stats
+
+def file_signature(path):
+    """(inode, size, mtime) of a file, changes whenever it is replaced or written; None when missing."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+def database_signatures():
+    """File signatures of every read-only database, None for missing ones."""
+    return [file_signature(current_app.config[f'{name.upper()}_DATABASE'])
+            for name in READONLY_DATABASES]
+
+def connect_readonly(path, immutable=True, mmap_size=0, cache_size=0, factory=sqlite3.Connection):
+    uri = 'file:' + pathname2url(os.path.abspath(path)) + '?mode=ro'
+    if immutable:
+        uri += '&immutable=1'
+
+    conn = sqlite3.connect(
+        uri,
+        uri=True,
+        detect_types=sqlite3.PARSE_DECLTYPES,
+        factory=factory
+    )
+    conn.row_factory = sqlite3.Row
+    if mmap_size:
+        conn.execute(f'PRAGMA mmap_size = {int(mmap_size)}')
+    if cache_size:
+        conn.execute(f'PRAGMA cache_size = {int(cache_size)}')
+    conn.execute('PRAGMA query_only = ON')
+    return conn
+
+def get_readonly_db(name):
+    """Return a read-only connection to one of the READONLY_DATABASES.
+
+    With DB_POOL enabled the connection lives for the whole life of the
+    worker thread and is reopened only when the file on disk is replaced.
+    Otherwise a fresh connection is opened on g and closed at teardown.
+    """
+    config = current_app.config
+    path = config[f'{name.upper()}_DATABASE']
+
+    if not config['DB_POOL']:
+        key = f'{name}_db'
+        if key not in g:
+            setattr(g, key, connect_readonly(
+                path, config['DB_IMMUTABLE'], config['DB_MMAP_SIZE'], config['DB_CACHE_SIZE'],
+                connection_class()
+            ))
+            _count('opened')
+        return getattr(g, key)
+
+    conns = getattr(_pool, 'conns', None)
+    if conns is None:
+        conns = _pool.conns = {}
+
+    signature = file_signature(path)
+    entry = conns.get(path)
+    if entry is not None:
+        conn, opened_signature = entry
+        if opened_signature == signature:
+            _count('reused')
+            return conn
+        # database file was rebuilt or swapped since we opened it
+        conn.close()
+        _count('closed')
+        _count('reopened')
+
+    conn = connect_readonly(
+        path, config['DB_IMMUTABLE'], config['DB_MMAP_SIZE'], config['DB_CACHE_SIZE'],
+        connection_class()
+    )
+    _count('opened')
+    conns[path] = (conn, signature)
+    return conn
+
+def close_readonly_dbs(e=None):
+    # only per-request connections are closed here, pooled ones outlive the request
+    for name in READONLY_DATABASES:
+        conn = g.pop(f'{name}_db', None)
+        if conn is not None:
+            conn.close()
+            _count('closed')
+
+def close_pool():
+    """Close every pooled connection owned by the calling thread."""
+    conns = getattr(_pool, 'conns', None) or {}
+    for conn, _ in conns.values():
+        conn.close()
+        _count('closed')
+    conns.clear()
+
+@contextmanager
+def replace_database(path, copy=False):
+    """Yield a connection to a new database file that replaces path once the
+    block completes, a copy of path with copy=True.
+
+    The web workers open the read-only databases immutable, so SQLite never
+    checks them for changes and a file written in place can be read half
+    updated. Every writer therefore builds a private file next to the live
+    one and swaps it in with os.replace, after which the pool reopens it. The
+    new file has journaling off; on error it is removed and path is left as
+    it was.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix=os.path.basename(path) + '.', suffix='.tmp', dir=directory)
+    os.close(fd)
+    try:
+        if copy:
+            shutil.copyfile(path, tmp_path)
+        if os.path.exists(path):
+            shutil.copymode(path, tmp_path)
+        else:
+            # mkstemp creates the file readable by its owner only
+            os.chmod(tmp_path, 0o644)
+        conn = sqlite3.connect(tmp_path, isolation_level=None)
+        try:
+            conn.execute('PRAGMA journal_mode = OFF')
+            conn.execute('PRAGMA synchronous = OFF')
+            yield conn
+        finally:
+            conn.close()
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
 
-def close_dnv_db(e=None):
-    dnv_db = g.pop('dnv_db', None)
-
-    if dnv_db is not None:
-        dnv_db.close()
+def get_dnv_db():
+    return get_readonly_db('dnv')
 
 def get_sample_db():
-    if 'sample_db' not in g:
-        g.sample_db = sqlite3.connect(
-            current_app.config["SAMPLE_DATABASE"],
-            detect_types=sqlite3.PARSE_DECLTYPES
-        )
-        g.sample_db.row_factory = sqlite3.Row
-
-    return g.sample_db
-
-def close_sample_db(e=None):
-    sample_db = g.pop('sample_db', None)
-
-    if sample_db is not None:
-        sample_db.close()
+    return get_readonly_db('sample')
 
 def get_sample_public_db():
     if 'sample_public_db' not in g:
@@ -75,68 +206,179 @@ def close_sample_public_db(e=None):
         sample_public_db.close()
 
 def get_gene_db():
-    if 'gene_db' not in g:
-        g.gene_db = sqlite3.connect(
-            current_app.config["GENE_DATABASE"],
-            detect_types=sqlite3.PARSE_DECLTYPES
-        )
-        g.gene_db.row_factory = sqlite3.Row
-
-    return g.gene_db
-
-def close_gene_db(e=None):
-    gene_db = g.pop('gene_db', None)
-
-    if gene_db is not None:
-        gene_db.close()
+    return get_readonly_db('gene')
 
 def get_distance_db():
-    if 'distance_db' not in g:
-        g.distance_db = sqlite3.connect(
-            current_app.config["DISTANCE_DATABASE"],
-            detect_types=sqlite3.PARSE_DECLTYPES
-        )
-        g.distance_db.row_factory = sqlite3.Row
-
-    return g.distance_db
-
-def close_distance_db(e=None):
-    distance_db = g.pop('distance_db', None)
-
-    if distance_db is not None:
-        distance_db.close()
+    return get_readonly_db('distance')
 
 def get_constraint_db():
-    if 'constraint_db' not in g:
-        g.constraint_db = sqlite3.connect(
-            current_app.config["CONSTRAINT_DATABASE"],
-            detect_types=sqlite3.PARSE_DECLTYPES
-        )
-        g.constraint_db.row_factory = sqlite3.Row
-
-    return g.constraint_db
-
-def close_constraint_db(e=None):
-    constraint_db = g.pop('constraint_db', None)
-
-    if constraint_db is not None:
-        constraint_db.close()
+    return get_readonly_db('constraint')
 
 def get_plddt_db():
-    if 'plddt_db' not in g:
-        g.plddt_db = sqlite3.connect(
-            current_app.config["PLDDT_DATABASE"],
-            detect_types=sqlite3.PARSE_DECLTYPES
-        )
-        g.plddt_db.row_factory = sqlite3.Row
-
-    return g.plddt_db
-
-def close_plddt_db(e=None):
-    plddt_db = g.pop('plddt_db', None)
-
-    if plddt_db is not None:
-        plddt_db.close()
+    return get_readonly_db('plddt')
+
+def get_misfit_db():
+    return get_readonly_db('misfit')
+
+# packed variant key matching protein_link.variant_keys(), NULL for anything but an SNV on a numbered chromosome
+VARIANT_KEY_SQL = """
+CASE WHEN CAST(Chrom AS INTEGER) > 0 AND Ref IN ('A', 'C', 'G', 'T') AND Alt IN ('A', 'C', 'G', 'T')
+THEN (((CAST(Chrom AS INTEGER) << 28) | Pos) << 4)
+     | ((CASE Ref WHEN 'A' THEN 0 WHEN 'C' THEN 1 WHEN 'G' THEN 2 ELSE 3 END) << 2)
+     | (CASE Alt WHEN 'A' THEN 0 WHEN 'C' THEN 1 WHEN 'G' THEN 2 ELSE 3 END)
+END
+"""
+
+# derived columns added before the indexes are built
+COLUMNS = (
+    ('MISFIT_DATABASE', 'misfit', 'variant_key', 'INTEGER', VARIANT_KEY_SQL),
+)
+
+# indexes backing the gene/sample lookups in views.py, gene.py and lollipop.py.
+# UPPER() expression indexes match the case-insensitive WHERE clauses exactly.
+INDEXES = (
+    ('DNV_DATABASE', 'dnvs', 'CREATE INDEX IF NOT EXISTS idx_dnvs_gene_upper ON dnvs (UPPER(gene))'),
+    ('DNV_DATABASE', 'dnvs', 'CREATE INDEX IF NOT EXISTS idx_sample ON dnvs (sample)'),
+    ('DNV_DATABASE', 'dnvs', 'CREATE INDEX IF NOT EXISTS idx_dnvs_chromosome_position ON dnvs (chromosome, position)'),
+    ('GENE_DATABASE', 'gene', 'CREATE INDEX IF NOT EXISTS idx_gene_hgnc_upper ON gene (UPPER(hgnc))'),
+    ('GENE_DATABASE', 'gene', 'CREATE INDEX IF NOT EXISTS idx_gene_ensembl_id ON gene (ensembl_id)'),
+    ('DISTANCE_DATABASE', 'distance', 'CREATE INDEX IF NOT EXISTS idx_distance_gene_upper ON distance (UPPER(gene))'),
+    ('CONSTRAINT_DATABASE', 'regional', 'CREATE INDEX IF NOT EXISTS idx_regional_gene_name_upper ON regional (UPPER(gene_name))'),
+    ('PLDDT_DATABASE', 'plddt', 'CREATE INDEX IF NOT EXISTS idx_plddt_uniprot_location ON plddt (UniProtID, location)'),
+    # covering, so upload lookups never touch the table itself
+    ('MISFIT_DATABASE', 'misfit', 'CREATE INDEX IF NOT EXISTS idx_misfit_variant_key ON misfit (variant_key, Symbol, Ensembl_protein_position, AA_ref, AA_alt)'),
+)
+
+# the hot lookups, each with a query picking a real parameter to time them with
+INDEXED_QUERIES = (
+    ('DNV_DATABASE', 'SELECT * FROM dnvs WHERE UPPER(dnvs.gene) = ?',
+        'SELECT UPPER(gene) FROM dnvs LIMIT 1'),
+    ('DNV_DATABASE', 'SELECT * FROM dnvs WHERE sample = ?',
+        'SELECT sample FROM dnvs LIMIT 1'),
+    ('DNV_DATABASE', 'SELECT * FROM dnvs WHERE chromosome = ? AND position BETWEEN 1 AND 1000000',
+        'SELECT chromosome FROM dnvs LIMIT 1'),
+    ('GENE_DATABASE', 'SELECT hgnc, uniprot_id, ensembl_id FROM gene WHERE ensembl_id = ?',
+        'SELECT ensembl_id FROM gene LIMIT 1'),
+    ('GENE_DATABASE', 'SELECT uniprot_id, uniprot_json FROM gene WHERE UPPER(hgnc) = ?',
+        'SELECT UPPER(hgnc) FROM gene LIMIT 1'),
+    ('DISTANCE_DATABASE', 'SELECT * FROM distance WHERE UPPER(gene) = ?',
+        'SELECT UPPER(gene) FROM distance LIMIT 1'),
+    ('CONSTRAINT_DATABASE', 'SELECT gene_name, start_aa, stop_aa, oe FROM regional WHERE UPPER(gene_name) = ?',
+        'SELECT UPPER(gene_name) FROM regional LIMIT 1'),
+    ('PLDDT_DATABASE', 'SELECT * FROM plddt WHERE UniProtID = ? ORDER BY location',
+        'SELECT UniProtID FROM plddt LIMIT 1'),
+    ('PLDDT_DATABASE', 'SELECT start, scores FROM plddt_packed WHERE UniProtID = ?',
+        'SELECT UniProtID FROM plddt_packed LIMIT 1'),
+    ('SAMPLE_DATABASE', 'SELECT * FROM samples WHERE sample = ?',
+        'SELECT sample FROM samples LIMIT 1'),
+    ('MISFIT_DATABASE', 'SELECT rowid, Symbol, Ensembl_protein_position, AA_ref, AA_alt FROM misfit WHERE variant_key IN (?)',
+        'SELECT variant_key FROM misfit WHERE variant_key IS NOT NULL LIMIT 1'),
+)
+
+def _has_table(conn, table):
+    return conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)
+    ).fetchone() is not None
+
+def _has_column(conn, table, column):
+    return column in [row[1] for row in conn.execute(f'PRAGMA table_info({table})')]
+
+def _has_index(conn, ddl):
+    # CREATE INDEX IF NOT EXISTS <name> ON ...
+    name = ddl.split()[5]
+    return conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = ?", (name,)
+    ).fetchone() is not None
+
+def _time_query(conn, query, param, repeat=5):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        conn.execute(query, (param,)).fetchall()
+        timings.append(time.perf_counter() - start)
+    return sorted(timings)[len(timings) // 2] * 1000
+
+def _query_plan(conn, query):
+    plan = conn.execute('EXPLAIN QUERY PLAN ' + query, (None,)).fetchall()
+    return [row[-1] for row in plan]
+
+def _uses_index(plan):
+    # a full read shows up as a bare "SCAN <table>" and sorting as a temp b-tree
+    return all(('USING' in step and 'INDEX' in step) or 'PRIMARY KEY' in step
+               for step in plan if step.startswith(('SCAN', 'SEARCH', 'USE TEMP B-TREE')))
+
+def _open_indexed_queries(config):
+    conns = {}
+    for key, query, param_query in INDEXED_QUERIES:
+        path = config[key]
+        if key not in conns:
+            conns[key] = sqlite3.connect(path) if os.path.exists(path) else None
+        conn = conns[key]
+        if conn is None:
+            continue
+        try:
+            row = conn.execute(param_query).fetchone()
+        except sqlite3.OperationalError:
+            continue
+        yield key, conn, query, row[0] if row else None
+    for conn in conns.values():
+        if conn is not None:
+            conn.close()
+
+@click.command('migrate-indexes')
+@with_appcontext
+def migrate_indexes_command():
+    """Add the lookup columns and indexes and check every hot query uses one.
+
+    Each database gaining a column or an index is rebuilt in a copy next to
+    it, which needs as much free disk space as the database itself.
+    """
+    config = current_app.config
+
+    before = {}
+    for key, conn, query, param in _open_indexed_queries(config):
+        before[query] = _time_query(conn, query, param)
+
+    # every database gaining a column or an index is copied once and swapped in
+    for key in dict.fromkeys([key for key, *_ in COLUMNS] + [key for key, _, _ in INDEXES]):
+        path = config[key]
+        if not os.path.exists(path):
+            click.echo(f'skip {os.path.basename(path)}: database not found')
+            continue
+        conn = connect_readonly(path, immutable=False)
+        columns = [(table, column, decl, expr) for k, table, column, decl, expr in COLUMNS
+                   if k == key and _has_table(conn, table) and not _has_column(conn, table, column)]
+        indexes = [ddl for k, table, ddl in INDEXES
+                   if k == key and _has_table(conn, table) and not _has_index(conn, ddl)]
+        conn.close()
+        if not columns and not indexes:
+            continue
+        with replace_database(path, copy=True) as conn:
+            for table, column, decl, expr in columns:
+                start = time.perf_counter()
+                with conn:
+                    conn.execute('BEGIN')
+                    conn.execute(f'ALTER TABLE {table} ADD COLUMN {column} {decl}')
+                    conn.execute(f'UPDATE {table} SET {column} = {expr}')
+                click.echo(f'{os.path.basename(path)}: added {table}.{column} ({time.perf_counter() - start:.1f}s)')
+            for ddl in indexes:
+                start = time.perf_counter()
+                conn.execute(ddl)
+                click.echo(f'{os.path.basename(path)}: {ddl} ({time.perf_counter() - start:.1f}s)')
+
+    unindexed = 0
+    for key, conn, query, param in _open_indexed_queries(config):
+        plan = _query_plan(conn, query)
+        ok = _uses_index(plan)
+        unindexed += not ok
+        after = _time_query(conn, query, param)
+        click.echo(f"[{'ok' if ok else 'SCAN'}] {query}")
+        click.echo(f"    plan: {'; '.join(plan)}")
+        if query in before:
+            click.echo(f'    {before[query]:.2f}ms -> {after:.2f}ms')
+
+    if unindexed:
+        raise click.ClickException(f'{unindexed} queries still scan a full table.')
 
 @click.command('init-db')
 def init_db_command():
@@ -146,6 +388,7 @@ def init_db_command():
 
 def init_app(app):
     app.teardown_appcontext(close_user_db)
-    app.teardown_appcontext(close_dnv_db)
-    app.teardown_appcontext(close_distance_db)
+    app.teardown_appcontext(close_sample_public_db)
+    app.teardown_appcontext(close_readonly_dbs)
     app.cli.add_command(init_db_command)
+    app.cli.add_command(migrate_indexes_command)
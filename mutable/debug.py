@@ -0,0 +1,42 @@
+import time
+
+from flask import Blueprint, abort, current_app, jsonify, render_template, send_file
+
+from mutable.auth import login_required
+from mutable.db import pool_stats
+from mutable.http_cache import stats as http_stats
+from mutable.profiler import get_profile, list_profiles
+
+bp = Blueprint('debug', __name__, url_prefix='/debug')
+
+# rows of the slow request listing
+PROFILES_SHOWN = 100
+
+
+@bp.route('/cache')
+@login_required
+def cache_stats():
+    return jsonify(
+        uniprot=current_app.extensions['uniprot_cache'].stats(),
+        db_pool=pool_stats(),
+        http=http_stats(),
+    )
+
+@bp.route('/profiles')
+@login_required
+def profiles():
+    """The slowest profiled requests still on disk."""
+    shown = list_profiles()[:PROFILES_SHOWN]
+    for profile in shown:
+        profile['captured'] = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(profile['time']))
+    return render_template('profiles.html', profiles=shown, enabled=current_app.config['PROFILE_ENABLED'])
+
+@bp.route('/profiles/<name>.prof')
+@login_required
+def profile(name):
+    """A saved profile, to be read with pstats or snakeviz."""
+    found = get_profile(name)
+    if found is None:
+        abort(404)
+    return send_file(found[1], mimetype='application/octet-stream', as_attachment=True,
+                     download_name=name + '.prof')
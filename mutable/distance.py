@@ -0,0 +1,216 @@
+import hashlib
+import os
+import time
+
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+
+import click
+import numpy as np
+import pandas as pd
+import sqlite3
+from flask import current_app
+from flask.cli import with_appcontext
+
+from mutable.db import connect_readonly, get_dnv_db, get_gene_db, replace_database
+from mutable.protein_link import contact_pairs
+from mutable.structure import centroid_frame, load_centroids
+
+DISTANCE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS distance (
+  gene TEXT,
+  id_of_variant_1 INTEGER,
+  resno_of_variant_1 INTEGER,
+  id_of_variant_2 INTEGER,
+  resno_of_variant_2 INTEGER,
+  distance_3d REAL,
+  distance_1d INTEGER
+);
+"""
+
+# fingerprint of the variants each gene's rows were computed from
+MANIFEST_SCHEMA = """
+CREATE TABLE IF NOT EXISTS distance_manifest (
+  gene TEXT PRIMARY KEY,
+  variants_hash TEXT NOT NULL
+) WITHOUT ROWID;
+"""
+
+# created after bulk loads, matches the UPPER(gene) lookup of the gene page
+DISTANCE_INDEX = "CREATE INDEX IF NOT EXISTS idx_distance_gene_upper ON distance (UPPER(gene))"
+
+INSERT_DISTANCE = "INSERT INTO distance VALUES (?, ?, ?, ?, ?, ?, ?)"
+
+# rows written per transaction while streaming worker results into the database
+BATCH_SIZE = 50000
+
+
+def signif(values, digits):
+    # R's signif(): round to a number of significant digits
+    values = np.asarray(values, dtype=np.float64)
+    with np.errstate(divide='ignore'):
+        magnitude = np.floor(np.log10(np.abs(values)))
+    decimals = np.where(np.isfinite(magnitude), digits - 1 - magnitude, 0)
+    scale = 10.0 ** decimals
+    return np.round(values * scale) / scale
+
+def load_missense(dnv_db, gene_db):
+    """Missense DNVs with their residue number and UniProt ID, one row per DNV."""
+    mut_df = pd.read_sql_query(
+        "SELECT id, gene, aa_change, consequence FROM dnvs WHERE aa_change IS NOT NULL", dnv_db
+    )
+    gene_df = pd.read_sql_query(
+        "SELECT hgnc, uniprot_id FROM gene WHERE uniprot_id IS NOT NULL", gene_db
+    )
+
+    # residue number after "p." as on the gene page, otherwise the first number
+    aa_change = mut_df['aa_change'].astype(str)
+    position = aa_change.str.extract(r'p\.\D*(\d+)')[0]
+    mut_df['aa_change'] = position.fillna(aa_change.str.extract(r'(\d+)')[0]).astype('Int64')
+    # only the first of several UniProt IDs has an AlphaFold model file name
+    gene_df['uniprot_id'] = gene_df['uniprot_id'].str.split(';').str[0]
+
+    df = mut_df.merge(gene_df, left_on='gene', right_on='hgnc', how='inner')
+    return df[df['consequence'].str.contains('missense', na=False)]
+
+def gene_distance_rows(gene, variants, uniprot_id, pdb_dir, centroid_dir, threshold):
+    """Distance table rows for every pair of a gene's variants closer than threshold."""
+    centroids = load_centroids(uniprot_id, pdb_dir, centroid_dir)
+    if centroids is None or len(centroids) == 0:
+        return []
+
+    variants = variants.drop_duplicates(subset=['aa_change'])
+    coords_df = pd.merge(variants, centroid_frame(centroids), left_on='aa_change', right_on='resno', how='inner')
+    if len(coords_df) <= 1:
+        return []
+
+    ids = coords_df['id'].to_numpy(dtype='int64')
+    resno = coords_df['aa_change'].to_numpy(dtype='int64')
+    first, second, dist_3d = contact_pairs(coords_df[['x','y','z']].to_numpy(dtype=np.float64), threshold)
+
+    # variant 1 is always the one with the lower residue number
+    swap = resno[first] > resno[second]
+    low = np.where(swap, second, first)
+    high = np.where(swap, first, second)
+
+    return list(zip(
+        repeat(gene), ids[low].tolist(), resno[low].tolist(), ids[high].tolist(), resno[high].tolist(),
+        signif(dist_3d, 3).tolist(), (resno[high] - resno[low]).tolist()
+    ))
+
+def _gene_distance_rows(args):
+    return args[0], gene_distance_rows(*args)
+
+def gene_tasks(df, pdb_dir, centroid_dir, threshold, genes=None):
+    for gene, variants in df.groupby('gene', sort=False):
+        if genes is not None and gene not in genes:
+            continue
+        # a single variant has nothing to pair with
+        if len(variants) > 1:
+            yield (gene, variants[['id', 'aa_change']], variants['uniprot_id'].iloc[0],
+                   pdb_dir, centroid_dir, threshold)
+
+def write_distances(conn, tasks, jobs):
+    """Compute gene tasks over a process pool and insert rows as they arrive.
+
+    Returns the number of genes and rows written.
+    """
+    n_genes = n_rows = pending = 0
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        conn.execute('BEGIN')
+        for gene, rows in executor.map(_gene_distance_rows, tasks, chunksize=8):
+            conn.executemany(INSERT_DISTANCE, rows)
+            n_genes += 1
+            n_rows += len(rows)
+            pending += len(rows)
+            if pending >= BATCH_SIZE:
+                conn.execute('COMMIT')
+                conn.execute('BEGIN')
+                pending = 0
+            if n_genes % 500 == 0:
+                click.echo(f'{n_genes} genes, {n_rows} pairs')
+        conn.execute('COMMIT')
+    return n_genes, n_rows
+
+def variant_hashes(df, threshold):
+    """Fingerprint of each gene's missense variants, used to find genes to recompute."""
+    hashes = {}
+    for gene, variants in df.groupby('gene', sort=False):
+        key = variants[['id', 'aa_change', 'uniprot_id']].sort_values('id').to_csv(index=False, header=False)
+        hashes[gene] = hashlib.sha1(f'{threshold}\n{key}'.encode('utf8')).hexdigest()
+    return hashes
+
+def built_hashes(path):
+    """The manifest of an existing distance.sqlite, empty when it has none."""
+    conn = connect_readonly(path, immutable=False)
+    try:
+        return dict(conn.execute("SELECT gene, variants_hash FROM distance_manifest").fetchall())
+    except sqlite3.OperationalError:
+        return {}
+    finally:
+        conn.close()
+
+def build_distance_db(jobs=None, threshold=15.0, incremental=False):
+    """Write distance.sqlite for every gene, or with incremental=True only for
+    genes whose missense variants changed since the last build.
+
+    Returns the number of genes recomputed and pairs written.
+    """
+    config = current_app.config
+    path = config['DISTANCE_DATABASE']
+
+    df = load_missense(get_dnv_db(), get_gene_db())
+    hashes = variant_hashes(df, threshold)
+
+    changed = None
+    if incremental and os.path.exists(path):
+        built = built_hashes(path)
+        if built:
+            changed = {gene for gene, h in hashes.items() if built.get(gene) != h}
+            changed |= set(built) - set(hashes)
+            if not changed:
+                return 0, 0
+        else:
+            # built without a manifest (e.g. by protein_link.R), nothing to compare against
+            click.echo('No manifest in the existing database, rebuilding every gene.')
+
+    with replace_database(path, copy=changed is not None) as conn:
+        conn.executescript(DISTANCE_SCHEMA + MANIFEST_SCHEMA)
+        if changed is not None:
+            with conn:
+                conn.execute('BEGIN')
+                conn.executemany(
+                    "DELETE FROM distance WHERE UPPER(gene) = UPPER(?) AND gene = ?",
+                    ((gene, gene) for gene in changed)
+                )
+                conn.executemany(
+                    "DELETE FROM distance_manifest WHERE gene = ?", ((gene,) for gene in changed)
+                )
+
+        tasks = gene_tasks(df, config['PDB_DIRECTORY'], config['CENTROID_DIRECTORY'], threshold, changed)
+        n_genes, n_rows = write_distances(conn, tasks, jobs)
+
+        with conn:
+            conn.execute('BEGIN')
+            conn.executemany(
+                "INSERT INTO distance_manifest (gene, variants_hash) VALUES (?, ?)",
+                ((gene, h) for gene, h in hashes.items() if changed is None or gene in changed)
+            )
+        conn.execute(DISTANCE_INDEX)
+
+    return len(hashes) if changed is None else len(changed), n_rows
+
+@click.command('build-distance-db')
+@click.option('--jobs', default=os.cpu_count(), show_default=True, help='Worker processes.')
+@click.option('--threshold', default=15.0, show_default=True, help='Contact distance cutoff in angstrom.')
+@click.option('--incremental', is_flag=True, help='Only recompute genes whose missense DNVs changed.')
+@with_appcontext
+def build_distance_db_command(jobs, threshold, incremental):
+    """Rebuild distance.sqlite from the missense DNVs and AlphaFold models."""
+    start = time.perf_counter()
+    n_genes, n_rows = build_distance_db(jobs, threshold, incremental)
+    elapsed = time.perf_counter() - start
+    click.echo(f'Recomputed {n_genes} genes, wrote {n_rows} pairs ({elapsed:.1f}s).')
+
+def init_app(app):
+    app.cli.add_command(build_distance_db_command)
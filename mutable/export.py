@@ -0,0 +1,142 @@
+import json
+import re
+
+from flask import Blueprint, abort, current_app, request, stream_with_context
+
+from mutable.api import TABLE_COLUMNS, format_rows, query_values, score_columns
+from mutable.auth import login_required
+from mutable.db import get_dnv_db
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:  # optional, only TSV exports are offered
+    pyarrow = None
+
+bp = Blueprint('export', __name__, url_prefix='/export')
+
+EXPORT_FORMATS = {"tsv": "text/tab-separated-values", "parquet": "application/vnd.apache.parquet"}
+
+# Parquet column types, the other columns are text; chromosome holds X/Y as
+# text, so it is exported as text too
+INTEGER_COLUMNS = ("position",)
+
+
+class _Chunks:
+    """Write-only file collecting what the Parquet writer emits, drained
+    after every row group."""
+
+    closed = False
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        data = b"".join(self.chunks)
+        self.chunks.clear()
+        return data
+
+
+def export_columns():
+    """Columns of an export, ?fields= picks the display_fields to include."""
+    scores = score_columns()
+    fields = query_values("fields")
+    if fields:
+        unknown = [field for field in fields if field not in scores]
+        if unknown:
+            abort(400, f"unknown fields {', '.join(unknown)}")
+        scores = tuple(field for field in scores if field in fields)
+    return ("gene",) + TABLE_COLUMNS + scores
+
+def parquet_schema(columns):
+    scores = set(score_columns())
+    types = []
+    for column in columns:
+        if column in INTEGER_COLUMNS:
+            types.append((column, pyarrow.int64()))
+        elif column in scores:
+            types.append((column, pyarrow.float64()))
+        else:
+            types.append((column, pyarrow.string()))
+    return pyarrow.schema(types)
+
+def parquet_rows(cursor, columns, batch_rows):
+    """Yield a Parquet file holding the cursor's rows, one row group per batch_rows."""
+    schema = parquet_schema(columns)
+    text = [i for i, field in enumerate(schema) if field.type == pyarrow.string()]
+    sink = _Chunks()
+    writer = pyarrow.parquet.ParquetWriter(sink, schema, compression="zstd")
+    while True:
+        rows = cursor.fetchmany(batch_rows)
+        if not rows:
+            break
+        arrays = [list(values) for values in zip(*rows)]
+        for i in text:
+            arrays[i] = [None if value is None else str(value) for value in arrays[i]]
+        writer.write_table(pyarrow.Table.from_arrays(arrays, schema=schema))
+        yield sink.drain()
+    writer.close()
+    yield sink.drain()
+
+def export_response(name, where, params):
+    """Stream the DNVs matching where as TSV or Parquet, never holding more
+    than EXPORT_BATCH_ROWS of them in memory."""
+    fmt = request.args.get("format", "tsv")
+    if fmt not in EXPORT_FORMATS:
+        abort(400, f"unknown format {fmt}")
+    if fmt == "parquet" and pyarrow is None:
+        abort(400, "Parquet export needs the pyarrow package")
+
+    columns = export_columns()
+    select = ", ".join(f'"{column}"' for column in columns)
+    # no ORDER BY: equality lookups already come off their index in id order,
+    # and sorting a gene set would make SQLite collect every row first
+    cursor = get_dnv_db().execute(f"SELECT {select} FROM dnvs WHERE {where}", params)
+    # only the tuples are needed, sqlite3.Row would build a mapping per row
+    cursor.row_factory = None
+
+    if fmt == "parquet":
+        body = parquet_rows(cursor, columns, current_app.config['EXPORT_BATCH_ROWS'])
+    else:
+        body = format_rows(cursor, columns, fmt)
+    response = current_app.response_class(stream_with_context(body), mimetype=EXPORT_FORMATS[fmt])
+    filename = re.sub(r"[^A-Za-z0-9_.-]", "_", name)
+    response.headers["Content-Disposition"] = f'attachment; filename="variants_{filename}.{fmt}"'
+    return response
+
+@bp.route('/gene/<gene>')
+@login_required
+def gene(gene):
+    gene = gene.upper().strip()
+    return export_response(gene, "UPPER(gene) = ?", [gene])
+
+@bp.route('/sample/<sample>')
+@login_required
+def sample(sample):
+    return export_response(sample, "sample = ?", [sample])
+
+@bp.route('/genes', methods=('GET', 'POST'))
+@login_required
+def genes():
+    """Export of a gene list, given as for /api/dnvs."""
+    gene_list = sorted({gene.upper() for gene in query_values("genes") + query_values("gene")})
+    if not gene_list:
+        abort(400, "give genes")
+    name = gene_list[0] if len(gene_list) == 1 else f"{len(gene_list)}_genes"
+    return export_response(name, "UPPER(gene) IN (SELECT value FROM json_each(?))",
+                           [json.dumps(gene_list)])
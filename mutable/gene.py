@@ -0,0 +1,224 @@
+import json
+import os
+import re
+
+from mutable.db import get_gene_db, get_distance_db, get_dnv_db, get_constraint_db, get_plddt_db
+from mutable.metrics import timed
+from mutable.plddt import get_plddt_track
+from mutable.uniprot import get_protein
+
+# datasets of the gene page plots, each fetched from /api/gene/<gene>/tracks/<track>
+GENE_TRACKS = ("variants", "consequences", "conditions", "sequence", "domains", "distance",
+               "constraints", "plddt")
+
+
+def get_display_fields():
+    # annotation columns shown in the DNV tables, see scripts/config.json
+    config_path = os.path.join(os.path.dirname(__file__), "scripts/config.json")
+    with open(config_path) as f:
+        return json.load(f).get("display_fields")
+
+def get_gene_metrics(gene):
+    """The gene table row shown in the gene page header, None for an unknown gene."""
+    return get_gene_db().execute(
+        """
+        SELECT pli, mis_z, oe_lof, mim_id, ensembl_id, uniprot_id, s_het_zeng, gene_full_name, MisFit_sgene_mis 
+        FROM gene 
+        WHERE UPPER(hgnc) = ?
+        """, (gene,)
+    ).fetchone()
+
+def gene_has_dnvs(gene):
+    return get_dnv_db().execute(
+        "SELECT 1 FROM dnvs WHERE UPPER(gene) = ? LIMIT 1", (gene,)
+    ).fetchone() is not None
+
+def gene_has_protein(gene, metrics):
+    """Whether the UniProt entry the sequence and domain tracks are drawn from loads."""
+    try:
+        get_protein(gene, metrics["uniprot_id"])
+    except Exception:
+        return False
+    return True
+
+def primary_uniprot_id(metrics):
+    # the first of several ';'-separated IDs, '' for a gene without one
+    return (metrics["uniprot_id"] or "").split(";")[0]
+
+def get_dnv_rows(gene, columns="*"):
+    return get_dnv_db().execute(
+        f"""
+        SELECT {columns}
+        FROM dnvs
+        WHERE UPPER(dnvs.gene) = ?
+        """, (gene,)
+    ).fetchall()
+
+def variant_tracks(rows):
+    """The variants, consequences and conditions datasets of a gene's DNV rows."""
+    seen = {}
+    consequences = set()
+    conditions = set()
+    more_than_one = False
+    for v in rows:
+        if v["aa_change"] != ".":
+            position = v["aa_change"].split(":")[-1]
+
+            consequences.add(v["consequence"].replace('_variant', ''))
+            conditions.add(v["cohort_condition"] if v["status"] == "affected" else v["status"])
+            try:
+                seen[v["aa_change"]]["count"] += 1
+                more_than_one = True
+            except KeyError:
+
+                seen[v["aa_change"]] = {
+                    "label": position,
+                    "position": int(re.search(r"p\.(\D*)(\d+)", position).group(2)),
+                    "count": 1,
+                    "gmvp": v["gmvp"] if (v["gmvp"] and ("missense" in v["consequence"])) else "none",
+                    "type": v["consequence"].replace('_variant', ''),
+                    "condition": v["cohort_condition"] if v["status"] == "affected" else v["status"],
+                    "alphamissense": "none",
+                    "misfit_d": "none"
+                }
+                if "MisFit_D" in v.keys() and ("missense" in v["consequence"]):
+                    seen[v["aa_change"]]["misfit_d"] = v["MisFit_D"]
+                
+                if "AlphaMissense" in v.keys() and ("missense" in v["consequence"]):
+                    seen[v["aa_change"]]["alphamissense"] = v["AlphaMissense"]
+
+                if "missense" not in v["consequence"]:
+                    seen[v["aa_change"]]["label"] = re.search(r"p\.(\D*)(\d+)", position).group(2)
+        
+    # need to work around vega bug, also looks nicer to have a larger range when only one counts
+    # this "variant" is not seen on plot due to some js logic
+    if not more_than_one:
+        seen["invisible"] = {
+            "position": 1,
+            "count": 2,
+            "type": "invisible"
+        }
+    
+    #order the missense ones to the front, for better coloring result in vega
+    consequences = sorted(consequences, key=lambda x: 0 if "missense" in x else 1)
+
+    return {"name": "variants", "values": list(seen.values())}, consequences, list(conditions)
+
+def protein_tracks(gene, metrics, rows):
+    """The sequence, domains and aa_change datasets, None without protein metrics."""
+    # fix issue when mutiple uniprot_id with multiple protein length
+    try:
+        with timed('gene.protein'):
+            protein = get_protein(gene, metrics["uniprot_id"])
+    except Exception:
+        # missing gene protein metrics
+        return None
+
+    # copy, the cached entry is shared with other requests
+    sequence_info = dict(protein["sequence"])
+    aa_change_max = sequence_info["length"]
+    for v in rows:
+        aa_info = v["aa_change"]
+        aa_pos = re.search(r'p\.\D*(\d+)', aa_info)
+        if aa_pos:
+            aa_change_max = max(aa_change_max, int(aa_pos.group(1))+1)
+        else:
+            continue
+    sequence_info["length"] = aa_change_max
+
+    sequence = {"name": "sequence", "values": sequence_info}
+    aa_change = {"name": "aa_change", "values": aa_change_max}
+    domains = {"name": "domains", "values": protein["domains"]}
+    return sequence, domains, aa_change
+
+def distance_track(gene):
+    dist = get_distance_db().execute(
+        """
+        SELECT * FROM distance WHERE UPPER(gene) = ?
+        """, (gene,)
+    ).fetchall()
+
+    dist_keys = ("gene","id_of_variant_1","resno_of_variant_1","id_of_variant_2","resno_of_variant_2","distance_3d","distance_1d")
+    dist = [dict(zip(dist_keys, values)) for values in dist]
+    return {"name": "distance", "values": dist}
+
+def constraints_track(gene):
+    #####new regionl depletion 
+    constraint = get_constraint_db().execute(
+        """
+        SELECT gene_name, start_aa, stop_aa, oe 
+        FROM regional 
+        WHERE UPPER(gene_name) = ?
+        """, (gene,)
+    ).fetchall()
+
+    constraint_dict = []
+    for item in constraint:
+        curr_row = {"gene_name": item[0], 
+                    "start_aa": int(re.search(r'\d+', item[1]).group()), 
+                    "stop_aa": int(re.search(r'\d+', item[2]).group()), 
+                    "oe": item[3]}
+        constraint_dict.append(curr_row)
+
+    return {"name": "constraints", "values": constraint_dict}
+
+def get_gene_track(gene, track):
+    """One dataset of get_gene_context, computed from only the queries it
+    needs. Returns None where get_gene_context would."""
+    metrics = get_gene_metrics(gene)
+    if metrics is None or not gene_has_protein(gene, metrics):
+        return None
+
+    if track in ("variants", "consequences", "conditions"):
+        rows = get_dnv_rows(gene)
+        if not rows:
+            return None
+        return variant_tracks(rows)[("variants", "consequences", "conditions").index(track)]
+
+    if track in ("sequence", "domains", "aa_change"):
+        rows = get_dnv_rows(gene, "aa_change")
+        if not rows:
+            return None
+        tracks = protein_tracks(gene, metrics, rows)
+        if tracks is None:
+            return None
+        return tracks[("sequence", "domains", "aa_change").index(track)]
+
+    # the tables below do not say whether the gene has DNVs
+    if not gene_has_dnvs(gene):
+        return None
+    if track == "distance":
+        return distance_track(gene)
+    if track == "constraints":
+        return constraints_track(gene)
+    if track == "plddt":
+        return get_plddt_track(get_plddt_db(), primary_uniprot_id(metrics))
+    raise KeyError(track)
+
+def get_gene_context(gene):
+    """Collect everything gene.html needs for an upper-cased HGNC symbol.
+
+    Returns None when the gene has no DNVs or no protein metrics.
+    """
+    rows = get_dnv_rows(gene)
+    metrics = get_gene_metrics(gene)
+
+    # handling error, when the gene does not exist in the database
+    if not rows or not metrics:
+        return None
+
+    protein = protein_tracks(gene, metrics, rows)
+    if protein is None:
+        return None
+    sequence, domains, aa_change = protein
+    variants, consequences, conditions = variant_tracks(rows)
+
+    #####new plddt
+    uniprot_id = primary_uniprot_id(metrics)
+
+    plddt = get_plddt_track(get_plddt_db(), uniprot_id)
+
+    return dict(gene=gene, metrics=metrics, variants=variants,
+                consequences=consequences, conditions=conditions, sequence=sequence, domains=domains,
+                distance=distance_track(gene), aa_change=aa_change, constraints=constraints_track(gene),
+                plddt=plddt, uniprot_id=uniprot_id)
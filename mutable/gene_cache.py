@@ -0,0 +1,130 @@
+import hashlib
+import json
+import os
+import time
+import zlib
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+
+from mutable.db import get_gene_db, get_readonly_db, replace_database
+from mutable.gene import GENE_TRACKS, get_gene_context
+
+# databases the gene payloads are derived from, the store is stale once any of them changes
+PAYLOAD_SOURCES = ('gene', 'dnv', 'distance', 'constraint', 'plddt')
+
+PAYLOAD_SCHEMA = """
+DROP TABLE IF EXISTS payload;
+DROP TABLE IF EXISTS meta;
+
+CREATE TABLE payload (
+  gene TEXT NOT NULL,
+  track TEXT NOT NULL,
+  body BLOB NOT NULL,
+  PRIMARY KEY (gene, track)
+) WITHOUT ROWID;
+
+CREATE TABLE meta (
+  key TEXT PRIMARY KEY,
+  value TEXT
+) WITHOUT ROWID;
+"""
+
+# bump when the layout of the store changes, stores of another format are not read
+PAYLOAD_FORMAT = '2'
+
+
+def source_versions():
+    versions = {}
+    for name in PAYLOAD_SOURCES:
+        try:
+            st = os.stat(current_app.config[f'{name.upper()}_DATABASE'])
+        except OSError:
+            return None
+        versions[name] = [st.st_size, st.st_mtime_ns]
+    return versions
+
+def data_version():
+    """Short digest of the source database versions, changes whenever any of
+    them is replaced or updated."""
+    digest = hashlib.sha1(json.dumps(source_versions()).encode('utf8'))
+    return digest.hexdigest()[:16]
+
+def encode_track(data):
+    return zlib.compress(json.dumps(data, separators=(',', ':')).encode('utf8'))
+
+def decode_track(body):
+    return json.loads(zlib.decompress(body))
+
+def load_gene_track(gene, track):
+    """Return one stored plot dataset of gene, or None when the store is
+    missing, stale or does not hold the gene."""
+    if not os.path.exists(current_app.config['GENE_PAYLOAD_DATABASE']):
+        return None
+
+    payload_db = get_readonly_db('gene_payload')
+    meta = dict(payload_db.execute(
+        "SELECT key, value FROM meta WHERE key IN ('format', 'sources')"
+    ).fetchall())
+    if meta.get('format') != PAYLOAD_FORMAT or \
+            'sources' not in meta or json.loads(meta['sources']) != source_versions():
+        return None
+
+    row = payload_db.execute(
+        "SELECT body FROM payload WHERE gene = ? AND track = ?", (gene, track)
+    ).fetchone()
+    if row is None:
+        return None
+
+    return decode_track(row['body'])
+
+def build_gene_cache():
+    """Precompute the plot datasets of every HGNC symbol into a fresh store,
+    one row per gene and track.
+
+    Returns the number of genes stored and the number of genes looked at.
+    """
+    path = current_app.config['GENE_PAYLOAD_DATABASE']
+    versions = source_versions()
+    if versions is None:
+        raise click.ClickException('All source databases must exist to build the gene cache.')
+
+    genes = [row['hgnc'] for row in get_gene_db().execute(
+        "SELECT DISTINCT UPPER(hgnc) AS hgnc FROM gene WHERE hgnc IS NOT NULL ORDER BY hgnc"
+    )]
+
+    written = 0
+    with replace_database(path) as conn:
+        conn.executescript(PAYLOAD_SCHEMA)
+        conn.execute('BEGIN')
+        for i, gene in enumerate(genes, 1):
+            context = get_gene_context(gene)
+            if context is not None:
+                conn.executemany(
+                    "INSERT INTO payload (gene, track, body) VALUES (?, ?, ?)",
+                    ((gene, track, encode_track(context[track])) for track in GENE_TRACKS)
+                )
+                written += 1
+            if i % 1000 == 0:
+                click.echo(f'{i}/{len(genes)} genes processed')
+
+        conn.executemany(
+            "INSERT INTO meta (key, value) VALUES (?, ?)",
+            (('format', PAYLOAD_FORMAT), ('sources', json.dumps(versions)))
+        )
+        conn.execute('COMMIT')
+        conn.execute('VACUUM')
+    return written, len(genes)
+
+@click.command('build-gene-cache')
+@with_appcontext
+def build_gene_cache_command():
+    """Precompute the gene page plot data of every HGNC symbol."""
+    start = time.perf_counter()
+    written, total = build_gene_cache()
+    click.echo(f"Stored {written} of {total} genes in {current_app.config['GENE_PAYLOAD_DATABASE']} "
+               f"({time.perf_counter() - start:.1f}s).")
+
+def init_app(app):
+    app.cli.add_command(build_gene_cache_command)
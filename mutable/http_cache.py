@@ -0,0 +1,118 @@
+import gzip
+import hashlib
+import os
+import threading
+
+from flask import current_app, g, request, session
+
+from mutable.auth import access_tier
+from mutable.db import database_signatures
+
+try:
+    import brotli
+except ImportError:  # optional, responses are gzipped only
+    brotli = None
+
+_stats_lock = threading.Lock()
+_stats = {'responses': 0, 'compressed': 0, 'gzip': 0, 'br': 0,
+          'bytes_in': 0, 'bytes_out': 0, 'not_modified': 0}
+
+def _count(**counts):
+    with _stats_lock:
+        for stat, n in counts.items():
+            _stats[stat] += n
+
+def stats():
+    with _stats_lock:
+        result = dict(_stats)
+    result['bytes_saved'] = result['bytes_in'] - result['bytes_out']
+    return result
+
+def code_version(root):
+    """Digest of the templates and modules, so a deploy invalidates ETags."""
+    h = hashlib.sha1()
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for name in sorted(filenames):
+            if name.endswith(('.py', '.html', '.json')):
+                path = os.path.join(dirpath, name)
+                h.update(f'{path}:{os.stat(path).st_mtime_ns}'.encode('utf8'))
+    return h.hexdigest()
+
+def _excluded(patterns):
+    endpoint = request.endpoint or ''
+    return any(endpoint == p or endpoint.startswith(p + '.') for p in patterns)
+
+def page_etag():
+    # pages only depend on the databases, the code and the access tier
+    key = repr((current_app.extensions['http_cache']['code_version'], database_signatures(),
+                access_tier(), request.full_path))
+    return hashlib.sha1(key.encode('utf8')).hexdigest()
+
+def conditional_get():
+    g.page_etag = None
+    if request.method not in ('GET', 'HEAD') or _excluded(current_app.config['ETAG_EXCLUDE']):
+        return None
+    # flashed messages are rendered once, the page has to be sent
+    if '_flashes' in session:
+        return None
+
+    g.page_etag = page_etag()
+    if request.if_none_match.contains_weak(g.page_etag):
+        _count(not_modified=1)
+        response = current_app.response_class(status=304)
+        response.set_etag(g.page_etag, weak=True)
+        response.headers['Cache-Control'] = 'private, no-cache'
+        response.vary.add('Cookie')
+        return response
+    return None
+
+def _encoding():
+    if brotli is not None and request.accept_encodings['br']:
+        return 'br'
+    if request.accept_encodings['gzip']:
+        return 'gzip'
+    return None
+
+def compress(data, encoding):
+    if encoding == 'br':
+        return brotli.compress(data, quality=current_app.config['COMPRESS_BROTLI_QUALITY'])
+    return gzip.compress(data, compresslevel=current_app.config['COMPRESS_LEVEL'], mtime=0)
+
+def finish_response(response):
+    config = current_app.config
+    if response.status_code == 200 and g.get('page_etag') and response.get_etag()[0] is None:
+        response.set_etag(g.page_etag, weak=True)
+        if 'Cache-Control' not in response.headers:
+            response.headers['Cache-Control'] = 'private, no-cache'
+        response.vary.add('Cookie')
+
+    if (response.status_code != 200 or response.direct_passthrough or response.is_streamed
+            or 'Content-Encoding' in response.headers
+            or response.mimetype not in config['COMPRESS_MIMETYPES']
+            or _excluded(config['COMPRESS_EXCLUDE'])):
+        return response
+
+    response.vary.add('Accept-Encoding')
+    data = response.get_data()
+    _count(responses=1)
+    encoding = _encoding()
+    if encoding is None or len(data) < config['COMPRESS_MIN_SIZE']:
+        _count(bytes_in=len(data), bytes_out=len(data))
+        return response
+
+    body = compress(data, encoding)
+    response.set_data(body)
+    response.headers['Content-Encoding'] = encoding
+    # the compressed body is no longer byte-identical to the one the strong tag named
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    _count(compressed=1, bytes_in=len(data), bytes_out=len(body), **{encoding: 1})
+    return response
+
+def init_app(app):
+    """Register after the blueprints, the ETags need the logged-in user."""
+    app.extensions['http_cache'] = {'code_version': code_version(app.root_path)}
+    app.before_request(conditional_get)
+    app.after_request(finish_response)
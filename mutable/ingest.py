@@ -0,0 +1,285 @@
+import csv
+import gzip
+import os
+import time
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+
+from mutable.db import replace_database
+
+# table -> (database config key, schema file, column rows are deduplicated on, required columns);
+# the gene pages expect "." rather than NULL for a missing dnvs aa_change
+TABLES = {
+    'dnvs': ('DNV_DATABASE', 'dnvs.sql', 'vid',
+             ('vid', 'chromosome', 'position', 'ref', 'alt', 'sample', 'gene', 'consequence', 'aa_change')),
+    'samples': ('SAMPLE_DATABASE', 'samples.sql', 'sample', ('sample',)),
+}
+
+MISSING_TEXT = '.'
+# text columns shown on the DNV tables, stored as MISSING_TEXT when missing or empty, as
+# for aa_change, so the pages never get a NULL to parse
+PLACEHOLDER_COLUMNS = {
+    'dnvs': ('status', 'cohort', 'cohort_condition', 'transcript', 'dna_change'),
+    'samples': (),
+}
+
+# VCF fixed fields and the dnvs columns they fill, annotations come from INFO
+VCF_FIELDS = {'#chrom': 'chromosome', 'pos': 'position', 'id': 'vid', 'ref': 'ref', 'alt': 'alt'}
+
+# values read as NULL in numeric and boolean columns; text columns keep them
+# as given, e.g. "." is the usual empty aa_change
+NULL_VALUES = {'', '.', 'NA', 'NaN', 'nan', 'None', 'NULL'}
+BOOLEAN_VALUES = {'1': 1, 'true': 1, 'yes': 1, 't': 1, '0': 0, 'false': 0, 'no': 0, 'f': 0}
+
+# chromosomes stored as text in the INTEGER chromosome column
+CHROMOSOME_NAMES = {'X', 'Y', 'M', 'MT'}
+
+BATCH_SIZE = 100000
+MAX_REPORTED_ERRORS = 10
+
+
+def _open_text(path):
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt', newline='')
+    return open(path, newline='')
+
+def read_tsv(path):
+    """Yield (line number, {lower-case header: value}) for a tab-separated file."""
+    with _open_text(path) as f:
+        reader = csv.reader(f, delimiter='\t', quoting=csv.QUOTE_NONE)
+        header = [name.strip().lower() for name in next(reader)]
+        for line_no, values in enumerate(reader, 2):
+            if values:
+                yield line_no, dict(zip(header, values))
+
+def read_vcf(path):
+    """Yield (line number, {field: value}) for a VCF, with INFO key=value
+    annotations as fields of their own."""
+    with _open_text(path) as f:
+        header = None
+        for line_no, line in enumerate(f, 1):
+            if line.startswith('##'):
+                continue
+            values = line.rstrip('\n').split('\t')
+            if header is None:
+                header = [name.lower() for name in values]
+                continue
+            record = dict(zip(header, values))
+            row = {VCF_FIELDS[k]: v for k, v in record.items() if k in VCF_FIELDS}
+            for item in record.get('info', '').split(';'):
+                key, sep, value = item.partition('=')
+                if sep:
+                    row[key.lower()] = value
+            if row.get('vid', '.') == '.':
+                # un-IDed records are keyed by the variant, and by the sample as the same
+                # site can be de novo in several of them
+                parts = [row.get(name, '') for name in ('chromosome', 'position', 'ref', 'alt')]
+                if row.get('sample'):
+                    parts.append(row['sample'])
+                row['vid'] = '-'.join(parts)
+            yield line_no, row
+
+def read_records(path):
+    if path.endswith(('.vcf', '.vcf.gz')):
+        return read_vcf(path)
+    return read_tsv(path)
+
+def table_columns(conn, table):
+    """{lower-case name: (name, declared type)} of the table, without the rowid alias."""
+    return {row[1].lower(): (row[1], row[2].upper()) for row in conn.execute(f'PRAGMA table_info({table})')
+            if not (row[5] and row[2].upper() == 'INTEGER')}
+
+def convert(name, decl, value):
+    """Value to store for a column, raises ValueError when it does not fit the type."""
+    value = value.strip()
+    if 'INT' in decl:
+        if value in NULL_VALUES:
+            return None
+        if name == 'chromosome':
+            value = value[3:] if value.lower().startswith('chr') else value
+            if value.upper() in CHROMOSOME_NAMES:
+                return value.upper()
+        return int(value)
+    if 'REAL' in decl or 'FLOA' in decl or 'DOUB' in decl:
+        if value in NULL_VALUES:
+            return None
+        return float(value)
+    if 'BOOL' in decl:
+        if value in NULL_VALUES:
+            return None
+        return BOOLEAN_VALUES[value.lower()]
+    return value if value != '' else None
+
+def _indexes(conn, table):
+    # only indexes created with CREATE INDEX, the UNIQUE constraint ones stay
+    return conn.execute(
+        "SELECT name, sql FROM sqlite_master WHERE type = 'index' AND tbl_name = ? AND sql IS NOT NULL",
+        (table,)
+    ).fetchall()
+
+def ingest(table, paths, replace=False, update=False, batch_size=BATCH_SIZE, max_errors=0):
+    """Load TSV or VCF files into table of its database.
+
+    The load runs on a copy without the secondary indexes, which replaces
+    the live file once the indexes are rebuilt and analyzed. Rows whose key
+    is already present are skipped, or overwrite the existing row with
+    update=True. More than max_errors invalid rows abort the load and leave
+    the live database untouched.
+    Returns a dict of counts and timings.
+    """
+    config_key, schema, key, required = TABLES[table]
+    path = current_app.config[config_key]
+
+    start = time.perf_counter()
+    with replace_database(path, copy=os.path.exists(path) and not replace) as conn:
+        has_table = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)
+        ).fetchone()
+        if not has_table:
+            schema_path = os.path.join(os.path.dirname(current_app.root_path), 'schema', schema)
+            with open(schema_path) as f:
+                conn.executescript(f.read())
+
+        conn.execute('PRAGMA cache_size = -262144')
+
+        indexes = _indexes(conn, table)
+        for name, _ in indexes:
+            conn.execute(f'DROP INDEX "{name}"')
+
+        columns = table_columns(conn, table)
+        stats = {'read': 0, 'written': 0, 'skipped': 0, 'rejected': 0}
+        insert_sql = None
+        batch = []
+
+        def flush():
+            conn.execute('BEGIN')
+            cursor = conn.executemany(insert_sql, batch)
+            conn.execute('COMMIT')
+            stats['written'] += cursor.rowcount
+            stats['skipped'] += len(batch) - cursor.rowcount
+            batch.clear()
+
+        for source in paths:
+            fields = None
+            is_vcf = source.endswith(('.vcf', '.vcf.gz'))
+            for line_no, record in read_records(source):
+                stats['read'] += 1
+                if fields is None:
+                    unknown = sorted(set(record) - set(columns))
+                    if unknown:
+                        click.echo(f"{os.path.basename(source)}: ignoring unknown columns {', '.join(unknown)}")
+                    # INFO differs between VCF records, take every column the table has
+                    present = columns if is_vcf else record
+                    missing = [name for name in required if name not in present]
+                    if missing:
+                        raise click.ClickException(
+                            f"{os.path.basename(source)}: missing required columns {', '.join(missing)}")
+                    # each file is flushed at its end, so its own header decides the columns
+                    given = [name for name in present if name in columns]
+                    fields = given + [name for name in PLACEHOLDER_COLUMNS[table]
+                                      if name in columns and name not in given]
+                    names = ', '.join(f'"{columns[name][0]}"' for name in fields)
+                    sql = (f'INSERT INTO {table} ({names}) VALUES ({", ".join("?" * len(fields))}) '
+                           f'ON CONFLICT("{key}") DO ')
+                    if update:
+                        sql += 'UPDATE SET ' + ', '.join(
+                            f'"{columns[name][0]}" = excluded."{columns[name][0]}"' for name in given if name != key)
+                    else:
+                        sql += 'NOTHING'
+                    insert_sql = sql
+
+                try:
+                    row = tuple(convert(name, columns[name][1], record.get(name, '')) for name in fields)
+                    row = tuple(MISSING_TEXT if value is None and name in PLACEHOLDER_COLUMNS[table] else value
+                                for name, value in zip(fields, row))
+                    if any(row[fields.index(name)] is None for name in required):
+                        raise ValueError('missing required value')
+                except (ValueError, KeyError) as e:
+                    stats['rejected'] += 1
+                    if stats['rejected'] <= MAX_REPORTED_ERRORS:
+                        click.echo(f'{os.path.basename(source)}:{line_no}: rejected ({e})')
+                    if stats['rejected'] > max_errors:
+                        raise click.ClickException(
+                            f"More than {max_errors} invalid rows, nothing was loaded.")
+                    continue
+
+                batch.append(row)
+                if len(batch) >= batch_size:
+                    flush()
+                    if stats['read'] % (batch_size * 10) == 0:
+                        click.echo(f"{stats['read']} rows read")
+            if batch:
+                flush()
+        stats['load_time'] = time.perf_counter() - start
+
+        index_start = time.perf_counter()
+        for name, sql in indexes:
+            conn.execute(sql)
+        stats['index_time'] = time.perf_counter() - index_start
+
+        analyze_start = time.perf_counter()
+        conn.execute(f'ANALYZE {table}')
+        stats['analyze_time'] = time.perf_counter() - analyze_start
+        stats['rows'] = conn.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]
+        conn.execute('PRAGMA journal_mode = DELETE')
+    return stats
+
+def report(table, stats):
+    rate = stats['read'] / stats['load_time'] if stats['load_time'] else 0
+    click.echo(f"{table}: read {stats['read']} rows, wrote {stats['written']}, "
+               f"skipped {stats['skipped']} duplicates, rejected {stats['rejected']}; {stats['rows']} rows in total.")
+    click.echo(f"load {stats['load_time']:.1f}s ({rate:.0f} rows/s), index rebuild {stats['index_time']:.1f}s, "
+               f"analyze {stats['analyze_time']:.1f}s")
+
+def refresh_derived():
+    """Bring the caches built from dnvs.sqlite up to date."""
+    from mutable.burden import build_burden
+    from mutable.distance import build_distance_db
+    from mutable.gene_cache import build_gene_cache
+
+    start = time.perf_counter()
+    n_genes, n_rows = build_distance_db(incremental=True)
+    click.echo(f'distance.sqlite: recomputed {n_genes} genes, wrote {n_rows} pairs '
+               f'({time.perf_counter() - start:.1f}s).')
+
+    start = time.perf_counter()
+    n_genes, n_rows = build_burden()
+    click.echo(f'burden.sqlite: counted {n_genes} genes in {n_rows} rows ({time.perf_counter() - start:.1f}s).')
+
+    # the payload store is optional, only rebuild it where it is in use
+    if os.path.exists(current_app.config['GENE_PAYLOAD_DATABASE']):
+        start = time.perf_counter()
+        written, total = build_gene_cache()
+        click.echo(f'gene_payload.sqlite: stored {written} of {total} genes '
+                   f'({time.perf_counter() - start:.1f}s).')
+
+def ingest_options(command):
+    command = click.argument('files', nargs=-1, required=True, type=click.Path(exists=True, dir_okay=False))(command)
+    command = click.option('--replace', is_flag=True, help='Start from an empty table.')(command)
+    command = click.option('--update', is_flag=True, help='Overwrite rows whose key is already present.')(command)
+    command = click.option('--batch-size', default=BATCH_SIZE, show_default=True, help='Rows per transaction.')(command)
+    command = click.option('--max-errors', default=0, show_default=True, help='Invalid rows to skip before giving up.')(command)
+    return command
+
+@click.command('ingest-dnvs')
+@ingest_options
+@click.option('--skip-derived', is_flag=True, help='Do not refresh distance.sqlite, burden.sqlite and the gene cache.')
+@with_appcontext
+def ingest_dnvs_command(files, replace, update, batch_size, max_errors, skip_derived):
+    """Load DNVs from TSV or annotated VCF files into dnvs.sqlite."""
+    report('dnvs', ingest('dnvs', files, replace, update, batch_size, max_errors))
+    if not skip_derived:
+        refresh_derived()
+
+@click.command('ingest-samples')
+@ingest_options
+@with_appcontext
+def ingest_samples_command(files, replace, update, batch_size, max_errors):
+    """Load samples from TSV files into samples.sqlite."""
+    report('samples', ingest('samples', files, replace, update, batch_size, max_errors))
+
+def init_app(app):
+    app.cli.add_command(ingest_dnvs_command)
+    app.cli.add_command(ingest_samples_command)
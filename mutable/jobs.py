@@ -0,0 +1,262 @@
+import fcntl
+import json
+import multiprocessing
+import os
+import re
+import shutil
+import socket
+import threading
+import time
+import traceback
+import uuid
+
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from concurrent.futures.process import BrokenProcessPool
+
+from flask import current_app
+
+from mutable.metrics import record_timings
+
+# jobs live in <JOB_DIRECTORY>/<id>/ so every web worker can report on them:
+# status.json is rewritten at each stage, result.json holds the outcome
+JOB_ID = re.compile(r'^[0-9a-f]{32}$')
+STATUS_FILE = 'status.json'
+RESULT_FILE = 'result.json'
+# <JOB_DIRECTORY>/slots/<kind>.<n>, locked by the job processes holding them
+SLOT_DIRECTORY = 'slots'
+
+# heartbeats a running job may miss before it is taken for dead
+MISSED_HEARTBEATS = 3
+
+_executor = None
+_executor_lock = threading.Lock()
+
+# the Flask app of a worker process, created once by _init_worker
+_worker_app = None
+
+
+def write_json(path, data):
+    # readers poll these files, never let them see a partial write
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+def read_json(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+class Job:
+    """Handle passed to a task, used to find its input and report progress."""
+
+    def __init__(self, path):
+        self.path = path
+        self.id = os.path.basename(path)
+        # seconds spent in each stage reported through progress()
+        self.timings = {}
+        self._stage = None
+        self._stage_start = None
+        # the heartbeat thread updates the status too
+        self._lock = threading.Lock()
+
+    def file(self, name):
+        return os.path.join(self.path, name)
+
+    def status(self):
+        return read_json(self.file(STATUS_FILE))
+
+    def update(self, **fields):
+        with self._lock:
+            status = self.status() or {}
+            status.update(fields, updated=time.time())
+            write_json(self.file(STATUS_FILE), status)
+
+    def progress(self, stage):
+        self.end_stage()
+        self._stage, self._stage_start = stage, time.perf_counter()
+        self.update(state='running', stage=stage)
+
+    def end_stage(self):
+        if self._stage is not None:
+            self.timings[self._stage] = time.perf_counter() - self._stage_start
+            self._stage = None
+
+def job_directory():
+    return current_app.config['JOB_DIRECTORY']
+
+def get_job(job_id):
+    """Return the job for an id, or None if the id is malformed or unknown.
+
+    A queued or running job that can no longer finish is marked failed first.
+    """
+    if not JOB_ID.match(job_id):
+        return None
+    job = Job(os.path.join(job_directory(), job_id))
+    status = job.status()
+    if status is None:
+        return None
+    if status['state'] in ('queued', 'running'):
+        error = stale_error(status)
+        if error is not None:
+            job.update(state='failed', error=error, finished=time.time())
+    return job
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def stale_error(status):
+    """Why a queued or running job will never finish, None while it still may.
+
+    Jobs are run by the pool of the web worker that created them, which a
+    restart takes down along with its queue; the pid checks only apply on the
+    host that ran the job.
+    """
+    config = current_app.config
+    now = time.time()
+    if now - status['created'] > config['JOB_TIMEOUT']:
+        return "The job took too long. Please submit again"
+    local = status.get('host') == socket.gethostname()
+    if status['state'] == 'queued':
+        lost = local and not _alive(status['owner'])
+    else:
+        lost = (local and not _alive(status['worker'])) or \
+            now - status['updated'] > config['JOB_HEARTBEAT'] * MISSED_HEARTBEATS
+    return "The job was interrupted. Please submit again" if lost else None
+
+def create_job(kind):
+    purge_jobs()
+    job_id = uuid.uuid4().hex
+    path = os.path.join(job_directory(), job_id)
+    os.makedirs(path)
+    job = Job(path)
+    job.update(id=job_id, kind=kind, state='queued', stage='queued', created=time.time(),
+               host=socket.gethostname(), owner=os.getpid())
+    return job
+
+def purge_jobs():
+    """Remove jobs older than JOB_TTL seconds."""
+    root = job_directory()
+    if not os.path.isdir(root):
+        return
+    cutoff = time.time() - current_app.config['JOB_TTL']
+    for job_id in os.listdir(root):
+        path = os.path.join(root, job_id)
+        if JOB_ID.match(job_id) and os.path.getmtime(path) < cutoff:
+            shutil.rmtree(path, ignore_errors=True)
+
+@contextmanager
+def worker_slots(kind, wanted, total):
+    """Claim up to wanted of the total slots of kind shared by every job on
+    the host, yields how many were claimed, possibly none.
+
+    A slot is an flock on a file under the job directory, released when the
+    block ends or the process holding it dies.
+    """
+    directory = os.path.join(job_directory(), SLOT_DIRECTORY)
+    os.makedirs(directory, exist_ok=True)
+    held = []
+    try:
+        for n in range(total):
+            if len(held) >= wanted:
+                break
+            f = open(os.path.join(directory, f'{kind}.{n}'), 'a')
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                f.close()
+                continue
+            held.append(f)
+        yield len(held)
+    finally:
+        for f in held:
+            f.close()
+
+def read_result(job):
+    return read_json(job.file(RESULT_FILE))
+
+def _init_worker(config):
+    global _worker_app
+    from mutable import create_app
+    _worker_app = create_app(config)
+
+def _heartbeat(job, interval, stop):
+    # refreshes status.json's updated time between stages
+    while not stop.wait(interval):
+        job.update()
+
+def _run(path, task):
+    job = Job(path)
+    with _worker_app.app_context():
+        job.update(state='running', started=time.time(), worker=os.getpid())
+        stop = threading.Event()
+        heartbeat = threading.Thread(target=_heartbeat, args=(job, _worker_app.config['JOB_HEARTBEAT'], stop),
+                                     daemon=True)
+        heartbeat.start()
+        try:
+            result = task(job)
+        except ValueError as e:
+            # raised by tasks for problems with the user's input
+            job.end_stage()
+            job.update(state='failed', error=str(e), finished=time.time(), timings=job.timings)
+            return
+        except Exception:
+            traceback.print_exc()
+            job.end_stage()
+            job.update(state='failed', error=None, finished=time.time(), timings=job.timings)
+            return
+        finally:
+            stop.set()
+            heartbeat.join()
+        job.end_stage()
+        write_json(job.file(RESULT_FILE), result)
+        job.update(state='done', stage='done', finished=time.time(), timings=job.timings)
+
+def _get_executor(app):
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            # spawn, forking a threaded web worker with open connections is unsafe
+            config = {k: v for k, v in app.config.items() if k.isupper()}
+            _executor = ProcessPoolExecutor(
+                max_workers=app.config['JOB_WORKERS'],
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=_init_worker,
+                initargs=(config,),
+            )
+        return _executor
+
+def _finished(path, future, metrics):
+    if metrics and not future.cancelled():
+        # stages ran in the worker process, report them from this one
+        status = Job(path).status() or {}
+        record_timings({f"{status.get('kind')}.{stage}": seconds
+                        for stage, seconds in (status.get('timings') or {}).items()})
+    # _run records its own outcome, this only sees workers that died or never started
+    if future.cancelled() or future.exception() is None:
+        return
+    print("The error in job", os.path.basename(path), "is", repr(future.exception()), flush=True)
+    Job(path).update(state='failed', error=None, finished=time.time())
+    if isinstance(future.exception(), BrokenProcessPool):
+        global _executor
+        with _executor_lock:
+            _executor = None
+
+def submit(job, task):
+    """Run task(job) in the worker pool and store what it returns as the result.
+
+    task must be a module-level function. It runs inside an app context and
+    raises ValueError with a message for the user when the input is invalid.
+    """
+    future = _get_executor(current_app._get_current_object()).submit(_run, job.path, task)
+    metrics = current_app.config['METRICS_ENABLED']
+    future.add_done_callback(lambda f: _finished(job.path, f, metrics))
@@ -1,100 +1,235 @@
 import sys
+import hashlib
 import json
-import sqlite3
 import re
 import os 
-import uuid
+import time
 import flask
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
 from flask import (
-    Blueprint, flash, g, redirect, render_template, request, url_for
+    Blueprint, flash, g, jsonify, redirect, render_template, request, url_for, current_app
 )
-from mutable.db import get_gene_db
-from mutable.protein_link import get_data, process_data, get_distance
+from werkzeug.exceptions import abort
+
+from mutable.db import get_gene_db, get_misfit_db
+from mutable.gene_cache import data_version
+from mutable.jobs import create_job, get_job, read_json, read_result, submit, worker_slots, write_json
+from mutable.protein_link import UploadError, get_data, process_data, get_distance
+from mutable.uniprot import get_protein
 
 
 bp = Blueprint('lollipop', __name__)
 
 ALLOWED_EXTENSION = {".tsv", ".txt", ".csv"}
 
-@bp.route('/lollipop/plot/<file>', methods=('GET', 'POST'))
-def generate_lollipop(file):
-    # print(file, flush=True)
-    ext = os.path.splitext(file)[1]
+# bump when the cached per-gene plots change shape
+LOLLIPOP_FORMAT = 1
+
+def submit_upload(file):
+    """Queue the plot of an uploaded file, returns the job or None if the
+    file type is not supported."""
+    ext = os.path.splitext(file.filename)[1]
     if ext not in ALLOWED_EXTENSION:
-        # print("File format not supported", flush=True)
-        flash("File format not supported")
-        return redirect(url_for('views.lollipop'))
-    
-    gene_db = get_gene_db()
-    pdb_path = os.path.join('/mutable/instance', "UP000005640_9606_HUMAN_v4")
+        return None
 
-    rdm_id = uuid.uuid4() #generate unique id for each uploaded file
+    purge_plots()
+    job = create_job('lollipop')
+    file.save(job.file('upload' + ext))
+    job.update(upload='upload' + ext)
+    submit(job, lollipop_task)
+    return job
 
+def lollipop_task(job):
+    """Job body, runs in a worker process."""
     try:
-        mut_df, gene_df, gene = get_data(file, gene_db)
-
-        #save the user uploaded file to temporary path (with null removed)
-        dnvs_path = os.path.join('/mutable/instance', f"{rdm_id}-dnvs.sqlite")
-        conn_dnvs = sqlite3.connect(dnvs_path)
-        mut_df.to_sql('dnvs', conn_dnvs, if_exists = "replace", index=True)
-
-        missense_df = process_data(mut_df, gene_df)
-        distance_df = get_distance(gene, missense_df, pdb_path, 15)
+        return build_lollipop(job.file(job.status()['upload']), job.progress)
+    except UploadError:
+        raise
     except Exception as e:
         print("The error in lollipop is", str(e), flush=True)
-        flash("File invalid. Please check and submit again")
+        raise ValueError("File invalid. Please check and submit again")
+
+@bp.route('/lollipop/job/<job_id>')
+def job_status(job_id):
+    job = get_job(job_id)
+    if job is None:
+        abort(404)
+
+    status = job.status()
+    return jsonify(
+        id=job.id,
+        state=status['state'],
+        stage=status['stage'],
+        error=status.get('error'),
+        result=url_for('lollipop.job_plot', job_id=job.id) if status['state'] == 'done' else None,
+    )
+
+@bp.route('/lollipop/job/<job_id>/plot')
+def job_plot(job_id):
+    job = get_job(job_id)
+    if job is None:
+        abort(404)
+
+    status = job.status()
+    if status['state'] == 'failed':
+        flash(status.get('error') or "File invalid. Please check and submit again")
         return redirect(url_for('views.lollipop'))
+    if status['state'] != 'done':
+        # polls job_status and comes back here once the plot is ready
+        return render_template('lollipop.html', job=status)
 
-    try:
-        dist_path = os.path.join('/mutable/instance', f"{rdm_id}-dist.sqlite")
-        conn_dist = sqlite3.connect(dist_path)
-        distance_df.to_sql('distance', conn_dist, if_exists = "replace", index=False)
+    genes = read_result(job)["genes"]
+    if len(genes) == 1:
+        # the cached plot may have been purged since the job finished
+        plot = load_plot(genes[0]["key"]) if genes[0]["key"] else None
+        if plot is None:
+            abort(404)
+        return render_template('display_lollipop.html', **plot)
+    return render_template('lollipop_genes.html', job=status, genes=genes)
 
-        print("Successfully write to database", flush=True)
-    except Exception as e:
-        print(f"Error writing to database: {e}", flush=True)
+@bp.route('/lollipop/job/<job_id>/plot/<gene>')
+def job_gene_plot(job_id, gene):
+    job = get_job(job_id)
+    if job is None or job.status()['state'] != 'done':
+        abort(404)
 
-    distance_db = conn_dist
-    conn_dist.row_factory = sqlite3.Row
+    entry = next((entry for entry in read_result(job)["genes"] if entry["gene"] == gene), None)
+    plot = load_plot(entry["key"]) if entry and entry["key"] else None
+    if plot is None:
+        abort(404)
+    return render_template('display_lollipop.html', **plot)
 
-    dnvs_db = conn_dnvs
-    dnvs_db.row_factory = sqlite3.Row
-    rows = dnvs_db.execute(
-        """
-        SELECT  gene,
-                consequence,
-                CAST(aa_change AS TEXT) as aa_change
-                FROM dnvs
-        """
-    ).fetchall()
+def upload_rows(mut_df):
+    # the uploaded variants as read (with null removed), before process_data
+    # reduces aa_change to the residue number
+    aa_change = mut_df['aa_change']
+    return pd.DataFrame({
+        "gene": mut_df['gene'],
+        "consequence": mut_df['consequence'],
+        "aa_change": aa_change.astype(str).where(aa_change.notna(), None),
+    }).to_dict('records')
 
-    gene = rows[0]['gene']
+def plot_key(rows):
+    """Content hash of one gene's uploaded variants and the databases its plot
+    is built from."""
+    h = hashlib.sha1(f"{LOLLIPOP_FORMAT}:{data_version()}:".encode('utf8'))
+    h.update(json.dumps(rows, separators=(',', ':')).encode('utf8'))
+    return h.hexdigest()
 
-    if len(rows) == 0:
-        flash("File invalid. Please check and submit again")
-        return redirect(url_for('views.lollipop'))
+def cache_path(key):
+    return os.path.join(current_app.config['LOLLIPOP_CACHE_DIRECTORY'], key + '.json')
+
+def load_plot(key):
+    path = cache_path(key)
+    plot = read_json(path)
+    if plot is not None:
+        # purge_plots goes by mtime, keep plots that are still being used
+        os.utime(path)
+    return plot
+
+def purge_plots():
+    """Remove cached plots unused for LOLLIPOP_CACHE_TTL seconds."""
+    cache_dir = current_app.config['LOLLIPOP_CACHE_DIRECTORY']
+    if not os.path.isdir(cache_dir):
+        return
+    cutoff = time.time() - current_app.config['LOLLIPOP_CACHE_TTL']
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        if name.endswith('.json') and os.path.getmtime(path) < cutoff:
+            os.remove(path)
+
+def gene_contacts(task):
+    """Residue contacts of one gene, runs in a worker process."""
+    gene, missense_df, pdb_path, centroid_path = task
+    if missense_df.empty:
+        return pd.DataFrame()
+    return get_distance(gene, missense_df, pdb_path, 15, centroid_path)
+
+def build_lollipop(file, progress):
+    """Plot every gene of an uploaded file.
+
+    Returns the index of the upload: one entry per gene, in file order, with
+    the key of its cached plot or the reason it could not be drawn.
+    progress(stage) is called as the stages start. Raises UploadError when the
+    file lacks required columns or holds no usable variants.
+    """
+    gene_db = get_gene_db()
+    pdb_path = current_app.config['PDB_DIRECTORY']
+    centroid_path = current_app.config['CENTROID_DIRECTORY']
+
+    progress('reading')
+    mut_df, gene_df = get_data(file, gene_db, get_misfit_db(),
+                               current_app.config['UPLOAD_CHUNK_ROWS'],
+                               current_app.config['UPLOAD_MEMORY_LIMIT'])
+    if mut_df.empty:
+        raise UploadError("File invalid. Please check and submit again")
+
+    missense_df = process_data(mut_df.copy(), gene_df)
+    genes = []
+    todo = []
+    for gene, gene_rows in mut_df.groupby('gene', sort=False):
+        rows = upload_rows(gene_rows)
+        key = plot_key(rows)
+        genes.append({"gene": gene, "key": key, "variants": len(rows)})
+        if not os.path.exists(cache_path(key)):
+            todo.append((gene, rows, key))
+
+    # contacts are the expensive part, spread the genes over the processes the
+    # other jobs of the host leave free
+    progress('contacts')
+    tasks = [(gene, missense_df[missense_df['gene'] == gene], pdb_path, centroid_path)
+             for gene, rows, key in todo]
+    wanted = min(current_app.config['LOLLIPOP_GENE_WORKERS'], len(tasks))
+    with worker_slots('lollipop', wanted if wanted > 1 else 0,
+                      current_app.config['LOLLIPOP_GENE_WORKER_SLOTS']) as workers:
+        if workers > 1:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                contacts = list(executor.map(gene_contacts, tasks))
+        else:
+            contacts = [gene_contacts(task) for task in tasks]
+
+    progress('plot')
+    errors = {}
+    for (gene, rows, key), distance_df in zip(todo, contacts):
+        try:
+            plot = gene_plot(gene, rows, distance_df)
+        except Exception as e:
+            print("The error in lollipop for", gene, "is", str(e), flush=True)
+            errors[gene] = "Gene not found"
+            continue
+        os.makedirs(os.path.dirname(cache_path(key)), exist_ok=True)
+        write_json(cache_path(key), plot)
+
+    for entry in genes:
+        if entry["gene"] in errors:
+            entry["key"] = None
+            entry["error"] = errors[entry["gene"]]
+    if all(entry["key"] is None for entry in genes):
+        raise UploadError("File invalid. Please check and submit again")
+    return {"genes": genes}
+
+def gene_plot(gene, rows, distance_df):
+    """Template context of display_lollipop.html for the rows of one gene."""
+    gene_db = get_gene_db()
 
     metrics = gene_db.execute(
         """
-        SELECT uniprot_id, uniprot_json
+        SELECT uniprot_id
         FROM gene 
         WHERE UPPER(hgnc) = ?
         """, (gene,)
     ).fetchone()
 
-    dist = distance_db.execute(
-        """
-        SELECT * FROM distance WHERE UPPER(gene) = ?
-        """, (gene,)
-    ).fetchall()
-
-    dist_keys = ("gene","resno_of_variant_1","resno_of_variant_2","distance_3d","distance_1d")
-    dist = [dict(zip(dist_keys, values)) for values in dist]
+    dist_keys = ["gene","resno_of_variant_1","resno_of_variant_2","distance_3d","distance_1d"]
+    if distance_df.empty:
+        dist = []
+    else:
+        dist = distance_df.loc[distance_df['gene'].str.upper() == gene, dist_keys].to_dict('records')
 
-
-    uniprot_json = json.loads(metrics["uniprot_json"])
-    sequence = {"name": "sequence", "values": uniprot_json["sequence"]}
-    domains = {"name": "domains", "values": [x for x in uniprot_json["features"] if x["type"] == "Domain" or x["type"] == "Region" or x["type"] == "DNA binding"]}
+    protein = get_protein(gene, metrics["uniprot_id"])
+    sequence = {"name": "sequence", "values": protein["sequence"]}
+    domains = {"name": "domains", "values": protein["domains"]}
     distance = {"name": "distance", "values": dist}
 
     seen = {}
@@ -138,12 +273,5 @@ def generate_lollipop(file):
             "type": "invisible"
         }
 
-    #remove temporary files immediately
-    if os.path.exists(dnvs_path):
-        os.remove(dnvs_path)
-
-    if os.path.exists(dist_path):
-        os.remove(dist_path)
-    
-    return render_template('display_lollipop.html', variants={"name": "variants", "values": list(seen.values())}, \
-                           consequences=list(consequences), sequence=sequence, domains=domains,distance=distance, gene=gene)
+    return dict(variants={"name": "variants", "values": list(seen.values())},
+                consequences=list(consequences), sequence=sequence, domains=domains, distance=distance, gene=gene)
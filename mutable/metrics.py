@@ -0,0 +1,256 @@
+import hashlib
+import re
+import sqlite3
+import threading
+import time
+
+from contextlib import contextmanager
+from functools import lru_cache
+
+from flask import Blueprint, abort, current_app, g, has_app_context, request
+
+bp = Blueprint('metrics', __name__)
+
+SECONDS_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+ROWS_BUCKETS = (0, 1, 10, 100, 1000, 10000, 100000, 1000000)
+
+# SQL of each query fingerprint, reported by mutable_sql_query_info
+MAX_QUERIES = 1000
+
+
+class Histogram:
+    """Cumulative Prometheus histogram, one series per label values tuple."""
+
+    def __init__(self, name, documentation, labels, buckets):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, values, amount):
+        with self._lock:
+            series = self._series.get(values)
+            if series is None:
+                series = self._series[values] = [[0] * len(self.buckets), 0, 0.0]
+            counts = series[0]
+            for i, bound in enumerate(self.buckets):
+                if amount <= bound:
+                    counts[i] += 1
+            series[1] += 1
+            series[2] += amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            series = sorted((values, [list(s[0]), s[1], s[2]]) for values, s in self._series.items())
+        for values, (counts, count, total) in series:
+            labels = ','.join(f'{k}="{_escape(v)}"' for k, v in zip(self.labels, values))
+            prefix = labels + ',' if labels else ''
+            for bound, n in zip(self.buckets, counts):
+                lines.append(f'{self.name}_bucket{{{prefix}le="{bound}"}} {n}')
+            lines.append(f'{self.name}_bucket{{{prefix}le="+Inf"}} {count}')
+            lines.append(f'{self.name}_sum{{{labels}}} {total}')
+            lines.append(f'{self.name}_count{{{labels}}} {count}')
+        return lines
+
+
+REQUEST_SECONDS = Histogram('mutable_request_seconds', 'Time to produce a response.',
+                            ('endpoint', 'method', 'status'), SECONDS_BUCKETS)
+QUERY_SECONDS = Histogram('mutable_sql_query_seconds', 'Time spent executing and fetching a query.',
+                          ('database', 'query'), SECONDS_BUCKETS)
+QUERY_ROWS = Histogram('mutable_sql_query_rows', 'Rows fetched from a query.',
+                       ('database', 'query'), ROWS_BUCKETS)
+STAGE_SECONDS = Histogram('mutable_stage_seconds', 'Time spent in a pipeline stage.',
+                          ('stage',), SECONDS_BUCKETS)
+HISTOGRAMS = (REQUEST_SECONDS, QUERY_SECONDS, QUERY_ROWS, STAGE_SECONDS)
+
+_queries = {}
+_queries_lock = threading.Lock()
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+@lru_cache(maxsize=1024)
+def fingerprint(sql):
+    """(short id, normalized text) of a query, literals and IN lists collapsed."""
+    text = re.sub(r"'(?:[^']|'')*'", '?', sql)
+    text = re.sub(r'\b\d+(?:\.\d+)?\b', '?', text)
+    text = re.sub(r'\(\s*\?(?:\s*,\s*\?)*\s*\)', '(?)', text)
+    text = ' '.join(text.split())
+    return hashlib.sha1(text.encode('utf8')).hexdigest()[:12], text
+
+def _add_timing(name, seconds):
+    # per-request totals for the Server-Timing header
+    if has_app_context() and current_app.config['SERVER_TIMING'] and 'server_timing' in g:
+        entry = g.server_timing.setdefault(name, [0.0, 0])
+        entry[0] += seconds
+        entry[1] += 1
+
+def record_query(database, sql, seconds, rows):
+    query_id, text = fingerprint(sql)
+    if query_id not in _queries:
+        with _queries_lock:
+            if len(_queries) < MAX_QUERIES:
+                _queries[query_id] = text
+    QUERY_SECONDS.observe((database, query_id), seconds)
+    QUERY_ROWS.observe((database, query_id), rows)
+    _add_timing('db', seconds)
+    # each query of a request being profiled, attached to its saved profile
+    if has_app_context() and 'profile_queries' in g:
+        g.profile_queries.append((f'{database}: {text}', seconds, rows))
+
+def record_stage(stage, seconds):
+    STAGE_SECONDS.observe((stage,), seconds)
+    _add_timing(stage, seconds)
+
+@contextmanager
+def timed(stage):
+    """Time the enclosed block as a pipeline stage when METRICS_ENABLED."""
+    if not current_app.config['METRICS_ENABLED']:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(stage, time.perf_counter() - start)
+
+
+class TimedCursor(sqlite3.Cursor):
+    """Cursor that reports each query once its rows are consumed, or when it
+    runs the next query or is dropped."""
+
+    _sql = None
+
+    def _finish(self):
+        if self._sql is not None:
+            record_query(self.connection.label, self._sql, self._elapsed, self._rows)
+            self._sql = None
+
+    def _timed(self, method, *args):
+        start = time.perf_counter()
+        try:
+            return method(*args)
+        finally:
+            self._elapsed += time.perf_counter() - start
+
+    def execute(self, sql, parameters=()):
+        self._finish()
+        self._sql, self._elapsed, self._rows = sql, 0.0, 0
+        self._timed(super().execute, sql, parameters)
+        return self
+
+    def fetchone(self):
+        row = self._timed(super().fetchone)
+        if row is None:
+            self._finish()
+        elif self._sql is not None:
+            self._rows += 1
+        return row
+
+    def fetchmany(self, size=None):
+        size = self.arraysize if size is None else size
+        rows = self._timed(super().fetchmany, size)
+        if self._sql is not None:
+            self._rows += len(rows)
+            if len(rows) < size:
+                self._finish()
+        return rows
+
+    def fetchall(self):
+        rows = self._timed(super().fetchall)
+        if self._sql is not None:
+            self._rows += len(rows)
+            self._finish()
+        return rows
+
+    def __next__(self):
+        try:
+            row = self._timed(super().__next__)
+        except StopIteration:
+            self._finish()
+            raise
+        if self._sql is not None:
+            self._rows += 1
+        return row
+
+    def close(self):
+        self._finish()
+        super().close()
+
+    def __del__(self):
+        self._finish()
+
+
+class TimedConnection(sqlite3.Connection):
+    """Connection whose queries are timed and fingerprinted, labelled with
+    the database file name."""
+
+    def __init__(self, database, *args, **kwargs):
+        super().__init__(database, *args, **kwargs)
+        self.label = str(database).split('?')[0].rsplit('/', 1)[-1]
+
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+
+def connection_class():
+    """sqlite3.connect factory, plain connections unless METRICS_ENABLED or PROFILE_ENABLED."""
+    config = current_app.config
+    return TimedConnection if config['METRICS_ENABLED'] or config['PROFILE_ENABLED'] else sqlite3.Connection
+
+def record_timings(timings):
+    """Observe stage timings measured in another process, e.g. by a job."""
+    for stage, seconds in timings.items():
+        STAGE_SECONDS.observe((stage,), seconds)
+
+def render():
+    lines = []
+    for histogram in HISTOGRAMS:
+        lines += histogram.render()
+    lines += ['# HELP mutable_sql_query_info Normalized SQL of a query fingerprint.',
+              '# TYPE mutable_sql_query_info gauge']
+    with _queries_lock:
+        queries = sorted(_queries.items())
+    for query_id, text in queries:
+        lines.append(f'mutable_sql_query_info{{query="{query_id}",sql="{_escape(text)}"}} 1')
+    return '\n'.join(lines) + '\n'
+
+@bp.route('/metrics')
+def metrics():
+    """Prometheus metrics of this worker process."""
+    if not current_app.config['METRICS_ENABLED']:
+        abort(404)
+    return current_app.response_class(render(), mimetype='text/plain; version=0.0.4')
+
+def start_timer():
+    if current_app.config['METRICS_ENABLED']:
+        g.request_start = time.perf_counter()
+        if current_app.config['SERVER_TIMING']:
+            g.server_timing = {}
+
+def finish_timer(response):
+    start = g.pop('request_start', None)
+    if start is None:
+        return response
+    elapsed = time.perf_counter() - start
+    if request.endpoint != 'metrics.metrics':
+        REQUEST_SECONDS.observe((request.endpoint or '', request.method, str(response.status_code)), elapsed)
+    timings = g.pop('server_timing', None)
+    if timings is not None:
+        entries = [f'{name};dur={seconds * 1000:.2f};desc="{count}x"'
+                   for name, (seconds, count) in timings.items()]
+        entries.append(f'total;dur={elapsed * 1000:.2f}')
+        response.headers['Server-Timing'] = ', '.join(entries)
+    return response
+
+def init_app(app):
+    # registered before http_cache, so a 304 is timed and compression is included
+    app.before_request(start_timer)
+    app.after_request(finish_timer)
@@ -0,0 +1,110 @@
+import base64
+import math
+import os
+import sqlite3
+import sys
+import time
+
+from array import array
+from itertools import groupby
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+
+from mutable.db import replace_database
+
+# one row per UniProt ID: the pLDDT of residues start, start + 1, ... as
+# little-endian float32, NaN where a residue has no score
+PACKED_SCHEMA = """
+DROP TABLE IF EXISTS plddt_packed;
+
+CREATE TABLE plddt_packed (
+  UniProtID TEXT PRIMARY KEY,
+  start INTEGER NOT NULL,
+  scores BLOB NOT NULL
+) WITHOUT ROWID;
+"""
+
+# rows written per transaction while packing
+BATCH_SIZE = 1000
+
+
+def pack_scores(residues):
+    """(start, blob) of (location, pLDDT) pairs sorted by location."""
+    scores = array('f')
+    start = None
+    for location, score in residues:
+        if start is None:
+            start = location
+        # gaps in the numbering become NaN, a repeated location keeps its first score
+        missing = location - start - len(scores)
+        if missing < 0:
+            continue
+        scores.extend([math.nan] * missing)
+        scores.append(math.nan if score is None else score)
+    if sys.byteorder != 'little':
+        scores.byteswap()
+    return start, scores.tobytes()
+
+def scores_track(start, blob):
+    """The pLDDT plot dataset, the scores kept as base64 float32 rather than a
+    record per residue; gene.html unpacks them in the browser."""
+    return {"name": "scores", "encoding": "float32", "start": start, "length": len(blob) // 4,
+            "pLDDT": base64.b64encode(blob).decode('ascii')}
+
+def get_plddt_track(plddt_db, uniprot_id):
+    try:
+        row = plddt_db.execute(
+            "SELECT start, scores FROM plddt_packed WHERE UniProtID = ?", (uniprot_id,)
+        ).fetchone()
+    except sqlite3.OperationalError:
+        # build-plddt-arrays has not been run, pack the per-residue rows instead
+        rows = plddt_db.execute(
+            "SELECT location, pLDDT FROM plddt WHERE UniProtID = ? ORDER BY location", (uniprot_id,)
+        )
+        rows.row_factory = None
+        start, blob = pack_scores(rows)
+    else:
+        start, blob = (row[0], row[1]) if row else (None, b'')
+    return scores_track(start or 1, blob)
+
+def pack_plddt(conn):
+    """Fill plddt_packed from the plddt table of conn, returns the proteins packed."""
+    conn.executescript(PACKED_SCHEMA)
+    rows = conn.execute("SELECT UniProtID, location, pLDDT FROM plddt ORDER BY UniProtID, location")
+    insert = conn.cursor()
+    packed = 0
+    conn.execute('BEGIN')
+    for uniprot_id, residues in groupby(rows, key=lambda row: row[0]):
+        start, blob = pack_scores((location, score) for _, location, score in residues)
+        insert.execute("INSERT INTO plddt_packed (UniProtID, start, scores) VALUES (?, ?, ?)",
+                       (uniprot_id, start, blob))
+        packed += 1
+        if packed % BATCH_SIZE == 0:
+            conn.execute('COMMIT')
+            conn.execute('BEGIN')
+    conn.execute('COMMIT')
+    return packed
+
+def build_plddt_arrays():
+    """Add plddt_packed to plddt.sqlite, returns the number of proteins packed."""
+    path = current_app.config['PLDDT_DATABASE']
+    if not os.path.exists(path):
+        raise click.ClickException(f'{path} not found.')
+
+    with replace_database(path, copy=True) as conn:
+        packed = pack_plddt(conn)
+        conn.execute('VACUUM')
+    return packed
+
+@click.command('build-plddt-arrays')
+@with_appcontext
+def build_plddt_arrays_command():
+    """Pack the per-residue pLDDT rows into one array per UniProt ID."""
+    start = time.perf_counter()
+    packed = build_plddt_arrays()
+    click.echo(f'Packed the pLDDT of {packed} proteins ({time.perf_counter() - start:.1f}s).')
+
+def init_app(app):
+    app.cli.add_command(build_plddt_arrays_command)
@@ -0,0 +1,132 @@
+import cProfile
+import io
+import os
+import pstats
+import threading
+import time
+import uuid
+
+from flask import current_app, g, request
+
+from mutable.jobs import read_json, write_json
+
+# endpoints never profiled, the listing itself and static files
+PROFILE_EXCLUDE = ('static', 'debug.profiles', 'debug.profile')
+
+# functions listed in the summary stored next to each profile
+SUMMARY_FUNCTIONS = 30
+
+_prune_lock = threading.Lock()
+
+
+def profile_directory():
+    return current_app.config['PROFILE_DIRECTORY']
+
+def start_profile():
+    if not current_app.config['PROFILE_ENABLED'] or request.endpoint in PROFILE_EXCLUDE:
+        return
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        # another request of this process is being profiled, Python 3.12+ allows one at a time
+        return
+    g.profiler = profiler
+    g.profile_start = time.perf_counter()
+    g.profile_queries = []
+
+def finish_profile(response):
+    profiler = g.pop('profiler', None)
+    if profiler is None:
+        return response
+    profiler.disable()
+    elapsed = time.perf_counter() - g.pop('profile_start')
+    queries = g.pop('profile_queries', [])
+    if elapsed >= current_app.config['PROFILE_THRESHOLD']:
+        save_profile(profiler, elapsed, response.status_code, queries)
+    return response
+
+def summary(profiler):
+    out = io.StringIO()
+    stats = pstats.Stats(profiler, stream=out)
+    stats.sort_stats('cumulative').print_stats(SUMMARY_FUNCTIONS)
+    return out.getvalue()
+
+def save_profile(profiler, elapsed, status, queries):
+    """Store the profile as <name>.prof (pstats format) and its request as <name>.json."""
+    directory = profile_directory()
+    os.makedirs(directory, exist_ok=True)
+    name = f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}"
+
+    # slowest queries first, repeated ones summed up under their SQL
+    by_sql = {}
+    for sql, seconds, rows in queries:
+        entry = by_sql.setdefault(sql, {'sql': sql, 'calls': 0, 'seconds': 0.0, 'rows': 0})
+        entry['calls'] += 1
+        entry['seconds'] += seconds
+        entry['rows'] += rows
+
+    profiler.dump_stats(os.path.join(directory, name + '.prof'))
+    write_json(os.path.join(directory, name + '.json'), {
+        'name': name,
+        'time': time.time(),
+        'method': request.method,
+        'path': request.full_path.rstrip('?'),
+        'endpoint': request.endpoint,
+        'args': request.view_args or {},
+        'status': status,
+        'elapsed': elapsed,
+        'db_seconds': sum(seconds for _, seconds, _ in queries),
+        'queries': sorted(by_sql.values(), key=lambda entry: -entry['seconds']),
+        'summary': summary(profiler),
+    })
+    prune_profiles(directory, current_app.config['PROFILE_MAX_BYTES'])
+
+def prune_profiles(directory, max_bytes):
+    """Delete the oldest profiles until the directory holds at most max_bytes."""
+    with _prune_lock:
+        profiles = {}
+        for entry in os.scandir(directory):
+            stem, ext = os.path.splitext(entry.name)
+            if ext in ('.prof', '.json'):
+                stat = entry.stat()
+                size, mtime = profiles.get(stem, (0, stat.st_mtime))
+                profiles[stem] = (size + stat.st_size, min(mtime, stat.st_mtime))
+        total = sum(size for size, _ in profiles.values())
+        for stem, (size, _) in sorted(profiles.items(), key=lambda item: item[1][1]):
+            if total <= max_bytes:
+                break
+            for ext in ('.prof', '.json'):
+                try:
+                    os.remove(os.path.join(directory, stem + ext))
+                except FileNotFoundError:
+                    pass
+            total -= size
+
+def list_profiles():
+    """Metadata of every stored profile, slowest first."""
+    directory = profile_directory()
+    if not os.path.isdir(directory):
+        return []
+    profiles = []
+    for filename in os.listdir(directory):
+        if filename.endswith('.json'):
+            profile = read_json(os.path.join(directory, filename))
+            if profile is not None:
+                profiles.append(profile)
+    return sorted(profiles, key=lambda profile: -profile['elapsed'])
+
+def get_profile(name):
+    """Metadata and .prof path of a stored profile, None if it is unknown."""
+    directory = profile_directory()
+    if os.path.basename(name) != name:
+        return None
+    profile = read_json(os.path.join(directory, name + '.json'))
+    if profile is None:
+        return None
+    return profile, os.path.join(directory, name + '.prof')
+
+def init_app(app):
+    # registered first, so the profile covers the other hooks of the request
+    app.before_request(start_profile)
+    app.after_request(finish_profile)
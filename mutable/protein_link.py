@@ -1,106 +1,163 @@
-import sqlite3
 import pandas as pd
 import re
-from Bio.PDB import *
-from Bio.PDB.PDBParser import PDBParser
 import os
-import gzip
-from sklearn.metrics.pairwise import pairwise_distances
-from flask import flash, redirect, url_for
-
-def get_data(file, genes_db):
+import numpy as np
+from scipy.spatial import cKDTree
+
+from mutable.structure import centroid_frame, load_centroids
+
+class UploadError(ValueError):
+    """An uploaded file is missing something, the message is shown to the user."""
+
+# column separator by upload extension, anything else is read as csv
+SEPARATORS = {".tsv": "\t", ".txt": " ", ".csv": ","}
+
+# the only columns an upload is read for, per format
+GENE_FORMAT_COLUMNS = ("gene", "aa_change", "consequence")
+VARIANT_FORMAT_COLUMNS = ("chrom", "pos", "ref", "alt", "consequence")
+
+# few distinct values, stored as categoricals while the upload is read
+CATEGORY_COLUMNS = ("consequence", "chrom", "ref", "alt")
+
+def read_upload(file, sep, columns, keep_rows, chunk_rows, memory_limit):
+    """Read the given (lower-case) columns of an upload chunk_rows lines at a
+    time, keeping the rows keep_rows(chunk) selects.
+
+    Raises UploadError once the kept rows use more than memory_limit bytes.
+    """
+    chunks = []
+    used = 0
+    reader = pd.read_csv(file, sep=sep, dtype=str, chunksize=chunk_rows,
+                         usecols=lambda name: name.lower() in columns)
+    for chunk in reader:
+        chunk.columns = chunk.columns.str.lower()
+        chunk = keep_rows(chunk)
+        for name in CATEGORY_COLUMNS:
+            if name in chunk:
+                chunk[name] = chunk[name].astype('category')
+        used += chunk.memory_usage(deep=True).sum()
+        if memory_limit and used > memory_limit:
+            raise UploadError("File too large. Please split it and submit again")
+        chunks.append(chunk)
+
+    if not chunks:
+        return pd.DataFrame(columns=list(columns))
+
+    mut_df = pd.concat(chunks, ignore_index=True)
+    for name in CATEGORY_COLUMNS:
+        if name in mut_df and len(chunks) > 1:
+            # concat falls back to object when the chunks saw different values
+            mut_df[name] = pd.api.types.union_categoricals([chunk[name] for chunk in chunks])
+    return mut_df
+
+def get_data(file, genes_db, misfit_db, chunk_rows=100000, memory_limit=None):
     ext = os.path.splitext(file)[1]
-    if ext == ".tsv":
-        mut_df = pd.read_csv(file, sep='\t')
-    elif ext == ".txt":
-        mut_df = pd.read_csv(file, sep=" ")
-    else: # csv file
-        mut_df = pd.read_csv(file)
+    sep = SEPARATORS.get(ext, ",")
 
     # uploaded file in variant format, with not aa_change column specified
-    mut_df.columns = mut_df.columns.str.lower()
+    columns = pd.read_csv(file, sep=sep, nrows=0).columns.str.lower()
     chr_names = ['chr', 'chrom', 'chromosome']
     pos_names = ['pos', 'position']
 
-    if 'aa_change' not in mut_df:
+    if 'aa_change' not in columns:
 
-        if "consequence" not in mut_df:
-            flash("Data should include consequence column.")
-            return redirect(url_for('views.lollipop'))
-        
-        if "chr" in mut_df:
-            mut_df.rename(columns={'gene': 'symbol'}, inplace=True)
+        if "consequence" not in columns:
+            raise UploadError("Data should include consequence column.")
         
-        if not any([n for n in chr_names if n in mut_df.columns]):
-            flash("Data should include CHROM column.")
-            return redirect(url_for('views.lollipop'))
-        else:
-            mut_df.rename(columns={'gene': 'symbol'}, inplace=True)
+        if not any([n for n in chr_names if n in columns]):
+            raise UploadError("Data should include CHROM column.")
         
-        if not any([n for n in pos_names if n in mut_df.columns]):
-            flash("Data should include POS column.")
-            return redirect(url_for('views.lollipop'))
+        if not any([n for n in pos_names if n in columns]):
+            raise UploadError("Data should include POS column.")
         
-        if "ref" not in mut_df:
-            flash("Data should include REF column.")
-            return redirect(url_for('views.lollipop'))
+        if "ref" not in columns:
+            raise UploadError("Data should include REF column.")
         
-        if "alt" not in mut_df:
-            flash("Data should include ALT column.")
-            return redirect(url_for('views.lollipop'))
+        if "alt" not in columns:
+            raise UploadError("Data should include ALT column.")
 
 
         ### More error debugging should goes here
 
-        mut_df['key'] = mut_df['chrom'].str.extract(r'(\d+)')[0].astype(str) + '-' + mut_df['pos'].astype(str) + '-' + mut_df['ref'].astype(str) + '-' + mut_df['alt'].astype(str)
-        mut_df = mut_df[mut_df["consequence"] == "missense"]
-
-        keys_set = set(mut_df['key'])
-
-        misfit_path = os.path.join('/mutable/instance', "misfit.sqlite")
-        conn = sqlite3.connect(misfit_path)
-        conn.row_factory = sqlite3.Row
+        # only missense variants are looked up in MisFit, drop the rest while reading
+        mut_df = read_upload(file, sep, VARIANT_FORMAT_COLUMNS,
+                             lambda chunk: chunk[chunk["consequence"] == "missense"],
+                             chunk_rows, memory_limit)
+        mut_df['key'] = mut_df['chrom'].astype(str).str.extract(r'(\d+)')[0].astype(str) + '-' + mut_df['pos'].astype(str) + '-' + mut_df['ref'].astype(str) + '-' + mut_df['alt'].astype(str)
 
         try:
-            param = ', '.join('?' * len(keys_set))
-            query = f"""
-                    SELECT  Symbol,
-                            Ensembl_protein_position,
-                            AA_ref,
-                            AA_alt
-                            FROM misfit
-                    WHERE (Chrom||'-'||Pos||'-'||Ref||'-'||Alt) IN ({param})
-                    """
-
-            res = pd.read_sql_query(query, conn, params=list(keys_set))
-            conn.close()
+            res = lookup_misfit(misfit_db, mut_df)
 
             res['gene'] = res['Symbol']
             res['consequence'] = "missense"
             res['aa_change'] = res['Ensembl_protein_position'].astype(str)+res['AA_ref']+'>'+res['Ensembl_protein_position'].astype(str)+res['AA_alt']
         except Exception as e:
             print("The error in protein_link is", e, flush=True)
+            raise UploadError("File invalid. Please check and submit again") from e
 
         mut_df = res
 
 
     # uploaded file in gene format (with aa_change column specified)
     else:
-        if "gene" not in mut_df:
-            flash("Data should include gene column.")
-            return redirect(url_for('views.lollipop'))
-
-        if "consequence" not in mut_df:
-            flash("Data file should include consequence column.")
-            return redirect(url_for('views.lollipop'))
+        if "gene" not in columns:
+            raise UploadError("Data should include gene column.")
 
-        mut_df = mut_df[mut_df["aa_change"].notna()]
+        if "consequence" not in columns:
+            raise UploadError("Data file should include consequence column.")
 
-    gene = mut_df['gene'].iloc[0]
+        mut_df = read_upload(file, sep, GENE_FORMAT_COLUMNS,
+                             lambda chunk: chunk[chunk["aa_change"].notna()],
+                             chunk_rows, memory_limit)
 
     gene_df = pd.read_sql_query("SELECT hgnc, uniprot_id FROM gene WHERE uniprot_id IS NOT NULL", genes_db)
-    return mut_df, gene_df, gene
-
+    return mut_df, gene_df
+
+
+# 2-bit codes of the bases packed into misfit.variant_key, see db.VARIANT_KEY_SQL
+BASE_CODES = {"A": 0, "C": 1, "G": 2, "T": 3}
+
+# bound parameters per lookup, below SQLite's default variable limit
+MISFIT_CHUNK_SIZE = 900
+
+def variant_keys(mut_df):
+    """Pack chrom/pos/ref/alt into one integer (chrom << 32 | pos << 4 | ref << 2 | alt)."""
+    chrom = pd.to_numeric(mut_df['chrom'].astype(str).str.extract(r'(\d+)')[0], errors='coerce')
+    pos = pd.to_numeric(mut_df['pos'], errors='coerce')
+    ref = mut_df['ref'].astype(str).str.upper().map(BASE_CODES)
+    alt = mut_df['alt'].astype(str).str.upper().map(BASE_CODES)
+    keys = ((chrom * 2**28 + pos) * 2**4 + ref * 4 + alt).dropna()
+    return keys.astype('int64').unique()
+
+def lookup_misfit(misfit_db, mut_df):
+    """MisFit rows matching the uploaded variants, in table order."""
+    has_key = any(row[1] == "variant_key" for row in misfit_db.execute("PRAGMA table_info(misfit)"))
+    if has_key:
+        keys = [int(key) for key in variant_keys(mut_df)]
+        condition = "variant_key IN ({})"
+    else:
+        # not migrated yet, the computed expression cannot use an index
+        keys = list(set(mut_df['key']))
+        condition = "(Chrom||'-'||Pos||'-'||Ref||'-'||Alt) IN ({})"
+
+    frames = []
+    for i in range(0, len(keys), MISFIT_CHUNK_SIZE):
+        chunk = keys[i:i + MISFIT_CHUNK_SIZE]
+        query = f"""
+                SELECT  rowid,
+                        Symbol,
+                        Ensembl_protein_position,
+                        AA_ref,
+                        AA_alt
+                        FROM misfit
+                WHERE {condition.format(', '.join('?' * len(chunk)))}
+                """
+        frames.append(pd.read_sql_query(query, misfit_db, params=chunk))
+
+    if not frames:
+        return pd.DataFrame(columns=["Symbol", "Ensembl_protein_position", "AA_ref", "AA_alt"])
+    res = pd.concat(frames, ignore_index=True).sort_values("rowid")
+    return res.drop(columns="rowid").reset_index(drop=True)
 
 def process_data(mut_df, gene_df):
     mut_df['aa_change'] = mut_df['aa_change'].str.extract(r'(\d+)')[0].astype('Int64')
@@ -108,46 +165,63 @@ def process_data(mut_df, gene_df):
     missense_df = df[df['consequence'] == 'missense']
     return missense_df
 
-def get_distance(gene, missense_df, pdb_dir, threshold):
+# precision float64 distances are compared and rounded at, see contact_pairs
+DISTANCE_DECIMALS = 9
+
+def contact_pairs(coords, threshold):
+    """Find every pair of points closer than threshold.
+
+    Returns index arrays (i, j) with i > j and their euclidean distances, in
+    the row-major order of the lower triangle of the full distance matrix.
+    """
+    n = len(coords)
+    if n < 2:
+        empty = np.empty(0, dtype=np.intp)
+        return empty, empty, np.empty(0, dtype=coords.dtype)
+
+    # query_pairs is inclusive of the radius, the strict cutoff is applied below
+    pairs = cKDTree(coords).query_pairs(threshold, output_type='ndarray')
+    j, i = pairs[:, 0], pairs[:, 1]
+
+    # same expansion and float64 upcast as sklearn's euclidean_distances, so
+    # float32 distances match the old full-matrix computation exactly
+    coords64 = coords.astype(np.float64)
+    sq_norms = (coords64 ** 2).sum(axis=1)
+    sq_dist = -2 * np.einsum('ij,ij->i', coords64[i], coords64[j]) + sq_norms[i] + sq_norms[j]
+    dist = np.sqrt(np.maximum(sq_dist.astype(coords.dtype), 0))
+    if dist.dtype == np.float64:
+        # float64 ones differ from the BLAS matrix product by up to ~1e-12, which
+        # could flip a pair at the cutoff or a rounding boundary. Coordinates have
+        # 3 decimals, so distinct distances are at least ~1e-8 apart and rounding
+        # to 1e-9 drops the noise without merging any of them.
+        dist = np.round(dist, DISTANCE_DECIMALS)
+
+    keep = dist < threshold
+    i, j, dist = i[keep], j[keep], dist[keep]
+    order = np.lexsort((j, i))
+    return i[order], j[order], dist[order]
+
+def get_distance(gene, missense_df, pdb_dir, threshold, centroid_dir=None):
     uniprot_id = missense_df.loc[missense_df['gene'] == gene]["uniprot_id"].iloc[0]
-    pdb_file = os.path.join(pdb_dir, f"AF-{uniprot_id}-F1-model_v4.pdb.gz")
+    centroids = load_centroids(uniprot_id, pdb_dir, centroid_dir)
 
-    if not os.path.exists(pdb_file):
-        return pd.DataFrame()
-        
-    parser = PDBParser(QUIET=True)
-    temp = gzip.open(pdb_file, "rt")
-    
-    structure = parser.get_structure('pdb', temp)
-    coords = []
-    for atom in structure.get_atoms():
-        res_id = atom.get_full_id()[3][1]
-        curr_coord = atom.get_coord()
-        coords.append([res_id, curr_coord[0], curr_coord[1], curr_coord[2]])
-    
-    coords_df = pd.DataFrame(coords, columns=['resno', 'x', 'y', 'z'])
-
-    if coords_df.shape[0] <= 1:
+    if centroids is None or len(centroids) == 0:
         return pd.DataFrame()
 
-    avg_coords = coords_df.groupby('resno').mean()
+    avg_coords = centroid_frame(centroids)
     missense_df = missense_df.drop_duplicates(subset=['aa_change'])
     coords_df = pd.merge(missense_df[missense_df['gene'] == gene], avg_coords, left_on='aa_change', right_on='resno', how='inner')
 
-    dist_mtx = pairwise_distances(coords_df[['x','y','z']], metric="euclidean")
-
-    close_nodes = []
-    for i in range(1, len(dist_mtx)):
-        for j in range(i):
-            if dist_mtx[i][j] < threshold:
-                resno1 = coords_df['aa_change'][i]
-                resno2 = coords_df['aa_change'][j]
-                dist_1d = abs(resno1 - resno2)
-                
-                if resno1 > resno2:
-                    close_nodes.append([gene, resno2, resno1, round(dist_mtx[i][j],3), dist_1d])
-                else:
-                    close_nodes.append([gene, resno1, resno2, round(dist_mtx[i][j],3), dist_1d])
-
-    res_df = pd.DataFrame(close_nodes, columns=["gene","resno_of_variant_1","resno_of_variant_2", "distance_3d", "distance_1d"])
+    resno = coords_df['aa_change'].to_numpy(dtype='int64')
+    first, second, dist_3d = contact_pairs(coords_df[['x','y','z']].to_numpy(), threshold)
+    resno1 = np.minimum(resno[first], resno[second])
+    resno2 = np.maximum(resno[first], resno[second])
+
+    res_df = pd.DataFrame({
+        "gene": gene,
+        "resno_of_variant_1": resno1,
+        "resno_of_variant_2": resno2,
+        "distance_3d": np.round(dist_3d, 3),
+        "distance_1d": resno2 - resno1,
+    }, columns=["gene","resno_of_variant_1","resno_of_variant_2", "distance_3d", "distance_1d"])
     return res_df
@@ -0,0 +1,126 @@
+import gzip
+import os
+import tempfile
+import time
+
+from concurrent.futures import ProcessPoolExecutor
+
+import click
+import numpy as np
+import pandas as pd
+from Bio.PDB.PDBParser import PDBParser
+from flask import current_app
+from flask.cli import with_appcontext
+
+# one record per residue: residue number and the mean coordinate of its atoms
+CENTROID_DTYPE = np.dtype([('resno', '<i4'), ('xyz', '<f4', (3,))])
+
+PDB_PREFIX = "AF-"
+PDB_SUFFIX = "-F1-model_v4.pdb.gz"
+
+
+def pdb_path(pdb_dir, uniprot_id):
+    return os.path.join(pdb_dir, f"{PDB_PREFIX}{uniprot_id}{PDB_SUFFIX}")
+
+def parse_centroids(pdb_file):
+    parser = PDBParser(QUIET=True)
+    with gzip.open(pdb_file, "rt") as temp:
+        structure = parser.get_structure('pdb', temp)
+
+    coords = []
+    for atom in structure.get_atoms():
+        res_id = atom.get_full_id()[3][1]
+        curr_coord = atom.get_coord()
+        coords.append([res_id, curr_coord[0], curr_coord[1], curr_coord[2]])
+
+    coords_df = pd.DataFrame(coords, columns=['resno', 'x', 'y', 'z'])
+
+    if coords_df.shape[0] <= 1:
+        return np.empty(0, dtype=CENTROID_DTYPE)
+
+    avg_coords = coords_df.groupby('resno').mean()
+    centroids = np.empty(len(avg_coords), dtype=CENTROID_DTYPE)
+    centroids['resno'] = avg_coords.index
+    centroids['xyz'] = avg_coords[['x', 'y', 'z']].to_numpy()
+    return centroids
+
+def centroid_frame(centroids):
+    # same shape as the per-residue groupby mean: x/y/z columns indexed by resno
+    return pd.DataFrame(
+        np.asarray(centroids['xyz']), columns=['x', 'y', 'z'],
+        index=pd.Index(centroids['resno'].astype('int64'), name='resno')
+    )
+
+def save_centroids(cache_file, centroids):
+    # write to a temporary file first so readers never see a partial array
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(cache_file), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, centroids)
+        os.replace(tmp_path, cache_file)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+def load_centroids(uniprot_id, pdb_dir, cache_dir=None):
+    """Return the residue centroids of a UniProt entry's AlphaFold model.
+
+    Arrays are read (memory-mapped) from cache_dir when present, otherwise
+    parsed from the PDB file and stored there. Returns None without a model.
+    """
+    if cache_dir is not None:
+        cache_file = os.path.join(cache_dir, f"{uniprot_id}.npy")
+        try:
+            return np.load(cache_file, mmap_mode='r')
+        except FileNotFoundError:
+            pass
+        except ValueError:
+            # older numpy cannot memory-map an empty array
+            return np.load(cache_file)
+
+    pdb_file = pdb_path(pdb_dir, uniprot_id)
+    if not os.path.exists(pdb_file):
+        return None
+
+    centroids = parse_centroids(pdb_file)
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        save_centroids(cache_file, centroids)
+    return centroids
+
+def _build_centroids(args):
+    uniprot_id, pdb_dir, cache_dir = args
+    load_centroids(uniprot_id, pdb_dir, cache_dir)
+    return uniprot_id
+
+@click.command('build-centroids')
+@click.option('--jobs', default=os.cpu_count(), show_default=True, help='Worker processes.')
+@click.option('--force', is_flag=True, help='Recompute arrays that are already cached.')
+@with_appcontext
+def build_centroids_command(jobs, force):
+    """Precompute residue centroids for every AlphaFold model."""
+    pdb_dir = current_app.config['PDB_DIRECTORY']
+    cache_dir = current_app.config['CENTROID_DIRECTORY']
+    os.makedirs(cache_dir, exist_ok=True)
+
+    uniprot_ids = []
+    for name in sorted(os.listdir(pdb_dir)):
+        if name.startswith(PDB_PREFIX) and name.endswith(PDB_SUFFIX):
+            uniprot_id = name[len(PDB_PREFIX):-len(PDB_SUFFIX)]
+            cache_file = os.path.join(cache_dir, f"{uniprot_id}.npy")
+            if force and os.path.exists(cache_file):
+                os.remove(cache_file)
+            if not os.path.exists(cache_file):
+                uniprot_ids.append(uniprot_id)
+
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        tasks = ((uniprot_id, pdb_dir, cache_dir) for uniprot_id in uniprot_ids)
+        for i, _ in enumerate(executor.map(_build_centroids, tasks, chunksize=16), 1):
+            if i % 1000 == 0:
+                click.echo(f'{i}/{len(uniprot_ids)} structures processed')
+
+    click.echo(f'Cached {len(uniprot_ids)} structures in {cache_dir} ({time.perf_counter() - start:.1f}s).')
+
+def init_app(app):
+    app.cli.add_command(build_centroids_command)
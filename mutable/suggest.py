@@ -0,0 +1,105 @@
+import threading
+
+from bisect import bisect_left
+from flask import current_app
+
+from mutable.db import file_signature, get_gene_db
+
+# what a query is matched against, in the order suggestions are listed
+KINDS = ("symbol", "ensembl_id", "uniprot_id", "name")
+
+
+class GeneIndex:
+    """Sorted prefix arrays over the identifiers and names in genes.sqlite.
+
+    Each kind keeps its lower-case keys in one sorted list, a lookup is a
+    bisect to the first key with the prefix followed by a short forward scan.
+    Full names are also indexed from every word, so "channel" finds
+    "sodium voltage-gated channel alpha subunit 2".
+    """
+
+    def __init__(self, rows):
+        entries = {kind: [] for kind in KINDS}
+        for hgnc, ensembl_id, uniprot_id, full_name in rows:
+            if not hgnc:
+                continue
+            gene = hgnc.upper()
+            entries["symbol"].append((gene.lower(), gene, gene))
+            for kind, ids in (("ensembl_id", ensembl_id), ("uniprot_id", uniprot_id)):
+                for value in (ids or "").split(";"):
+                    value = value.strip()
+                    if value:
+                        entries[kind].append((value.lower(), gene, value))
+            if full_name:
+                words = full_name.lower().split()
+                for i in range(len(words)):
+                    entries["name"].append((" ".join(words[i:]), gene, full_name))
+
+        self.keys = {}
+        self.values = {}
+        for kind, kind_entries in entries.items():
+            kind_entries.sort()
+            self.keys[kind] = [entry[0] for entry in kind_entries]
+            self.values[kind] = [entry[1:] for entry in kind_entries]
+
+    def __len__(self):
+        return sum(len(keys) for keys in self.keys.values())
+
+    def suggest(self, query, limit):
+        """Up to limit {"gene", "kind", "match"} dicts for genes with a key
+        starting with query, one per gene."""
+        prefix = " ".join(query.lower().split())
+        if not prefix:
+            return []
+        seen = set()
+        results = []
+        for kind in KINDS:
+            keys, values = self.keys[kind], self.values[kind]
+            i = bisect_left(keys, prefix)
+            while i < len(keys) and len(results) < limit and keys[i].startswith(prefix):
+                gene, match = values[i]
+                if gene not in seen:
+                    seen.add(gene)
+                    results.append({"gene": gene, "kind": kind, "match": match})
+                i += 1
+        return results
+
+    def resolve(self, query):
+        """The gene whose symbol or ID is exactly query, None if there is no
+        single one."""
+        key = query.strip().lower()
+        for kind in ("symbol", "ensembl_id", "uniprot_id"):
+            keys, values = self.keys[kind], self.values[kind]
+            i = bisect_left(keys, key)
+            genes = set()
+            while i < len(keys) and keys[i] == key:
+                genes.add(values[i][0])
+                i += 1
+            if genes:
+                return genes.pop() if len(genes) == 1 else None
+        return None
+
+
+class _IndexHolder:
+    # one index per worker process, rebuilt when genes.sqlite is replaced
+    def __init__(self):
+        self.index = None
+        self.signature = None
+        self.lock = threading.Lock()
+
+
+def get_gene_index():
+    holder = current_app.extensions['gene_index']
+    signature = file_signature(current_app.config['GENE_DATABASE'])
+    if holder.index is None or holder.signature != signature:
+        with holder.lock:
+            if holder.index is None or holder.signature != signature:
+                rows = get_gene_db().execute(
+                    "SELECT hgnc, ensembl_id, uniprot_id, gene_full_name FROM gene"
+                ).fetchall()
+                holder.index = GeneIndex(rows)
+                holder.signature = signature
+    return holder.index
+
+def init_app(app):
+    app.extensions['gene_index'] = _IndexHolder()
@@ -0,0 +1,117 @@
+import json
+import threading
+import time
+
+from collections import OrderedDict
+from flask import current_app
+
+from mutable.db import file_signature, get_gene_db
+
+DOMAIN_TYPES = ("Domain", "Region", "DNA binding")
+
+
+class LRUCache:
+    """Thread-safe LRU cache bounded by entry count, total weight and age."""
+
+    def __init__(self, maxsize, ttl=None, max_weight=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.max_weight = max_weight
+        self.weight = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, weight, expires = entry
+                if expires is None or expires > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                self._remove(key)
+                self.expirations += 1
+            self.misses += 1
+            return None
+
+    def put(self, key, value, weight=1):
+        if self.max_weight is not None and weight > self.max_weight:
+            return
+        expires = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, weight, expires)
+            self.weight += weight
+            while len(self._entries) > self.maxsize or \
+                    (self.max_weight is not None and self.weight > self.max_weight):
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.weight = 0
+
+    def _remove(self, key):
+        _, weight, _ = self._entries.pop(key)
+        self.weight -= weight
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "maxsize": self.maxsize,
+                "weight": self.weight,
+                "max_weight": self.max_weight,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+
+
+def get_protein(gene, uniprot_id):
+    """Return the parsed sequence info and domain features of a gene's UniProt entry.
+
+    The result is shared between requests and must not be modified by callers.
+    Raises ValueError when the gene has no usable UniProt document.
+    """
+    cache = current_app.extensions['uniprot_cache']
+    # entries of a replaced genes.sqlite are never hit again and age out of the LRU
+    key = (file_signature(current_app.config['GENE_DATABASE']), uniprot_id or gene)
+    protein = cache.get(key)
+    if protein is not None:
+        return protein
+
+    row = get_gene_db().execute(
+        """
+        SELECT uniprot_json
+        FROM gene
+        WHERE UPPER(hgnc) = ?
+        """, (gene,)
+    ).fetchone()
+    if row is None or not row["uniprot_json"]:
+        raise ValueError(f"no UniProt entry for {gene}")
+
+    uniprot_json = json.loads(row["uniprot_json"])
+    protein = {
+        "sequence": uniprot_json["sequence"],
+        "domains": [x for x in uniprot_json["features"] if x["type"] in DOMAIN_TYPES],
+    }
+    # size of the raw document approximates the footprint of the parsed entry
+    cache.put(key, protein, len(row["uniprot_json"]))
+    return protein
+
+def init_app(app):
+    app.extensions['uniprot_cache'] = LRUCache(
+        app.config['UNIPROT_CACHE_SIZE'],
+        app.config['UNIPROT_CACHE_TTL'],
+        app.config['UNIPROT_CACHE_MAX_BYTES'],
+    )
@@ -25,4 +25,6 @@ CREATE TABLE dnvs (
   gnomAD4_AF REAL,
   vid TEXT UNIQUE);
 
-  CREATE INDEX idx_sample ON dnvs (sample);
\ No newline at end of file
+  CREATE INDEX idx_sample ON dnvs (sample);
+  CREATE INDEX idx_dnvs_gene_upper ON dnvs (UPPER(gene));
+  CREATE INDEX idx_dnvs_chromosome_position ON dnvs (chromosome, position);
\ No newline at end of file